@@ -0,0 +1,202 @@
+"""
+Detection analytics over birds_log.csv
+======================================
+
+Loads the bird detection log once into typed NumPy arrays (int64 epoch
+seconds + int32 device codes), appends new detections as app.py logs them
+and answers the usual questions with vectorized operations:
+
+- inter-arrival time histogram (per nest, or all nests)
+- busiest hours of the day per nest
+- detections per day with day-over-day change
+
+Epochs are the log's local wall-clock time read as UTC, so hour-of-day and
+day boundaries match the timestamps written in the CSV.
+"""
+
+import csv
+import threading
+
+import numpy as np
+
+DAY = 86400
+HOUR = 3600
+
+# Default inter-arrival bin edges in seconds (log-spaced, 1 s .. 1 week)
+INTER_ARRIVAL_BINS = [0, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600,
+                      3 * 3600, 6 * 3600, 12 * 3600, DAY, 2 * DAY, 7 * DAY]
+
+
+def to_epoch(timestamps):
+    """'YYYY-MM-DD HH:MM:SS' strings -> int64 epoch seconds"""
+    return np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+
+
+# NaT as int64; an empty timestamp parses to NaT instead of raising
+NAT = np.iinfo(np.int64).min
+
+
+def _epoch_or_nat(timestamp):
+    try:
+        return to_epoch([timestamp])[0]
+    except ValueError:
+        return NAT
+
+
+def parse_rows(timestamps, device_ids):
+    """(epochs, device_ids) of rows whose timestamp parses; malformed rows
+    are left out instead of failing the whole load"""
+    try:
+        epochs = to_epoch(timestamps)
+    except ValueError:
+        epochs = np.array([_epoch_or_nat(t) for t in timestamps], dtype=np.int64)
+    keep = epochs != NAT
+    return epochs[keep], [d for d, k in zip(device_ids, keep) if k]
+
+
+def day_epoch(date):
+    """'YYYY-MM-DD' -> epoch seconds of midnight"""
+    return int(np.datetime64(date, 's').astype(np.int64))
+
+
+def day_string(epoch_day):
+    return str(np.datetime64(int(epoch_day) * DAY, 's'))[:10]
+
+
+class DetectionStore:
+    """Detections as columnar arrays; thread safe, loaded on first query"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.devices = []       # code -> device_id
+        self.codes_by_id = {}   # device_id -> code
+        self.epochs = np.empty(0, dtype=np.int64)
+        self.codes = np.empty(0, dtype=np.int32)
+        self.size = 0
+
+    def _code(self, device_id):
+        code = self.codes_by_id.get(device_id)
+        if code is None:
+            code = self.codes_by_id[device_id] = len(self.devices)
+            self.devices.append(device_id)
+        return code
+
+    def _reserve(self, extra):
+        """Grow the arrays geometrically so appends are amortized O(1)"""
+        needed = self.size + extra
+        if needed <= len(self.epochs):
+            return
+        capacity = max(needed, 2 * len(self.epochs), 1024)
+        epochs = np.empty(capacity, dtype=np.int64)
+        codes = np.empty(capacity, dtype=np.int32)
+        epochs[:self.size] = self.epochs[:self.size]
+        codes[:self.size] = self.codes[:self.size]
+        self.epochs, self.codes = epochs, codes
+
+    def load(self):
+        """Read the whole CSV; the caller holds app.csv_lock"""
+        timestamps, device_ids = [], []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                next(reader, None)  # Skip header
+                for row in reader:
+                    if len(row) >= 2:
+                        timestamps.append(row[0])
+                        device_ids.append(row[1])
+        except FileNotFoundError:
+            pass
+
+        epochs, device_ids = parse_rows(timestamps, device_ids)
+        with self.lock:
+            self.devices, self.codes_by_id, self.size = [], {}, 0
+            self._reserve(len(epochs))
+            self.epochs[:len(epochs)] = epochs
+            self.codes[:len(epochs)] = [self._code(d) for d in device_ids]
+            self.size = len(epochs)
+            self.loaded = True
+
+    def append(self, timestamps, device_id):
+        """Add one nest's detections logged at `timestamps`; no-op until
+        loaded, since load() reads them from the CSV anyway"""
+        with self.lock:
+            if not self.loaded:
+                return
+            count = len(timestamps)
+            self._reserve(count)
+            self.epochs[self.size:self.size + count] = to_epoch(timestamps)
+            self.codes[self.size:self.size + count] = self._code(device_id)
+            self.size += count
+
+    def _select(self, device=None, since=None, until=None):
+        """Copy of (epochs, codes) filtered by nest and [since, until) epoch range"""
+        with self.lock:
+            epochs = self.epochs[:self.size].copy()
+            codes = self.codes[:self.size].copy()
+            code = self.codes_by_id.get(device) if device else None
+        mask = np.ones(len(epochs), dtype=bool)
+        if device:
+            if code is None:
+                mask[:] = False
+            else:
+                mask &= codes == code
+        if since is not None:
+            mask &= epochs >= since
+        if until is not None:
+            mask &= epochs < until
+        return epochs[mask], codes[mask]
+
+    # Queries
+    def inter_arrival(self, device=None, since=None, until=None, bins=None):
+        """Histogram of seconds between consecutive detections of the same nest"""
+        epochs, codes = self._select(device, since, until)
+        order = np.lexsort((epochs, codes))
+        epochs, codes = epochs[order], codes[order]
+        same_nest = codes[1:] == codes[:-1]
+        gaps = (epochs[1:] - epochs[:-1])[same_nest]
+        edges = np.asarray(bins or INTER_ARRIVAL_BINS, dtype=np.int64)
+        counts, _ = np.histogram(gaps, bins=edges)
+        return {
+            'count': int(len(gaps)),
+            'bins_sec': edges.tolist(),
+            'counts': counts.tolist(),
+            'median_sec': float(np.median(gaps)) if len(gaps) else None,
+            'mean_sec': round(float(gaps.mean()), 1) if len(gaps) else None,
+        }
+
+    def busiest_hours(self, device=None, since=None, until=None, top=3):
+        """Detections per hour of day for each nest, with its busiest hours"""
+        epochs, codes = self._select(device, since, until)
+        n = len(self.devices)
+        hours = (epochs % DAY) // HOUR
+        table = np.bincount(codes.astype(np.int64) * 24 + hours, minlength=n * 24).reshape(n, 24)
+        busiest = np.argsort(-table, axis=1, kind='stable')[:, :top]
+        nests = {}
+        for code in np.flatnonzero(table.sum(axis=1)):
+            row = table[code]
+            nests[self.devices[code]] = {
+                'total': int(row.sum()),
+                'by_hour': row.tolist(),
+                'busiest': [int(h) for h in busiest[code] if row[h]],
+            }
+        return {'nests': nests}
+
+    def daily_trend(self, device=None, since=None, until=None):
+        """Detections per day and change against the previous day"""
+        epochs, _ = self._select(device, since, until)
+        if not len(epochs):
+            return {'days': []}
+        days = epochs // DAY
+        first = int(days.min())
+        counts = np.bincount(days - first)
+        change = np.diff(counts, prepend=counts[0])
+        previous = np.concatenate(([0], counts[:-1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = np.where(previous > 0, change * 100.0 / np.maximum(previous, 1), np.nan)
+        return {'days': [
+            {'date': day_string(first + i), 'count': int(c), 'change': int(d),
+             'change_pct': None if np.isnan(p) else round(float(p), 1)}
+            for i, (c, d, p) in enumerate(zip(counts, change, pct))
+        ]}
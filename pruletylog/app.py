@@ -2,25 +2,58 @@ import asyncio
 import threading
 import json
 import csv
+import hashlib
+import multiprocessing
 import os
 import random
 import socket
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime
 from flask import Flask, request, render_template, jsonify, send_file
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from werkzeug.utils import secure_filename
 import paho.mqtt.client as mqtt
 
+try:
+    import analytics  # needs numpy
+except ImportError:
+    analytics = None
+
+try:
+    import msgpack  # optional compact wire format
+except ImportError:
+    msgpack = None
+
 # Flask + SocketIO setup
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this'
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# Pre-encoded JSON payloads (history/stats snapshots) are spliced into
+# Socket.IO packets as-is instead of being serialized again for each emit
+class RawJSON(str):
+    """A string that already is an encoded JSON value"""
+
+class SnapshotJSON:
+    """json module for Socket.IO that passes RawJSON arguments through"""
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        if isinstance(obj, list) and any(isinstance(item, RawJSON) for item in obj):
+            return '[' + ','.join(item if isinstance(item, RawJSON) else json.dumps(item, *args, **kwargs)
+                                  for item in obj) + ']'
+        return json.dumps(obj, *args, **kwargs)
+
+    loads = staticmethod(json.loads)
+
 # Public API Flask app
 public_app = Flask(__name__)
 public_app.config['SECRET_KEY'] = 'public-api-key'
-public_socketio = SocketIO(public_app, cors_allowed_origins="*")
+public_socketio = SocketIO(public_app, cors_allowed_origins="*", json=SnapshotJSON)
 
 # MQTT Configuration
 MQTT_BROKER = "ip"
@@ -29,6 +62,17 @@ MQTT_BASE_TOPIC = "prulety"
 MQTT_USERNAME = "user"
 MQTT_PASSWORD = "pass"
 
+# Public API workers: 0 = public server runs as a thread of this process.
+# N > 0 = N worker processes on ports PUBLIC_PORT .. PUBLIC_PORT + N - 1
+# (put a load balancer with sticky sessions in front). This process then
+# publishes each detection once on PUBLIC_BUS_TOPIC and every worker fans
+# it out to its own clients.
+PUBLIC_PORT = 4120
+PUBLIC_WORKERS = 0
+PUBLIC_BUS_TOPIC = f"{MQTT_BASE_TOPIC}-internal/public_detection"
+public_workers = {}  # port -> multiprocessing.Process
+in_public_worker = False  # set in the worker processes themselves
+
 # Shared state
 connected_devices = {}
 admin_clients = []
@@ -36,14 +80,72 @@ device_last_data = {}  # Store last received data from each device
 ota_servers = {}  # Active OTA HTTP servers {device_id: {'port': port, 'server': server, 'thread': thread}}
 mqtt_client = None
 
+# Public API rooms: clients that did not subscribe to specific nests
+# stay in ALL_NESTS_ROOM and receive every detection
+ALL_NESTS_ROOM = 'nest:*'
+public_subscriptions = {}  # sid -> set of device_ids
+room_stats = {}  # room -> {'members': n, 'sent': n}
+rooms_lock = threading.Lock()
+
+# Nests a public client may subscribe to: devices in the birds log (fed by
+# the bus in public workers) or registered over MQTT, at most this many per client
+known_devices = set()
+MAX_SUBSCRIPTIONS = 32
+
+def nest_room(device_id):
+    return f"nest:{device_id}"
+
+def is_known_device(device_id):
+    return device_id in known_devices or device_id in connected_devices
+
 # OTA firmware directory
 FIRMWARE_DIR = 'ota_firmware'
 os.makedirs(FIRMWARE_DIR, exist_ok=True)
 
+# Ingest latency tracing (MQTT receive -> ack published), last N detections
+LATENCY_WINDOW = 500
+ingest_latency = deque(maxlen=LATENCY_WINDOW)
+latency_lock = threading.Lock()
+
+def detection_trace_id(device_id, device_timestamp, seq=None):
+    """Trace id for a detection sent without one; the NVR derives it the same
+    way (device id + device timestamp + seq), so both traces correlate"""
+    if device_timestamp is None:
+        return uuid.uuid4().hex[:12]
+    key = f"{device_id}/{device_timestamp}/{'' if seq is None else seq}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def record_ingest_latency(trace_id, device_id, rx_time):
+    """Record how long one bird_detection took from MQTT receive to ack"""
+    elapsed = time.time() - rx_time
+    with latency_lock:
+        ingest_latency.append(elapsed)
+    print(f"[TRACE] {trace_id} {device_id} ingest {elapsed * 1000:.1f} ms")
+
+def latency_summary():
+    """Percentile summary of recorded ingest latencies in milliseconds"""
+    with latency_lock:
+        values = sorted(ingest_latency)
+    if not values:
+        return {'count': 0}
+
+    def pct(p):
+        return round(values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))] * 1000, 2)
+
+    return {'count': len(values), 'p50_ms': pct(50), 'p90_ms': pct(90), 'p99_ms': pct(99),
+            'max_ms': round(values[-1] * 1000, 2)}
+
 # CSV logging
 CSV_FILE = 'device_log.csv'
 BIRDS_CSV_FILE = 'birds_log.csv'
 csv_lock = threading.Lock()
+birds_log_version = 0  # bumped on every bird detection, keys the snapshot cache
+BIRDS_CSV_HEADER = ['timestamp', 'device_id', 'device_timestamp', 'seq']
+
+# Replayed detections (same device, seq and device timestamp) are dropped;
+# the last DEDUP_WINDOW keys per device are remembered
+DEDUP_WINDOW = 5000
+seen_detections = {}  # device_id -> (deque of keys, set of keys)
 
 def init_csv():
     """Initialize CSV file with headers if it doesn't exist"""
@@ -57,7 +159,33 @@ def init_birds_csv():
     if not os.path.exists(BIRDS_CSV_FILE):
         with open(BIRDS_CSV_FILE, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
-            writer.writerow(['timestamp', 'device_id', 'device_timestamp'])
+            writer.writerow(BIRDS_CSV_HEADER)
+        return
+
+    with open(BIRDS_CSV_FILE, 'r', newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    if rows and rows[0] != BIRDS_CSV_HEADER:
+        # Older log without the seq column: rewrite the header once
+        tmp = BIRDS_CSV_FILE + '.tmp'
+        with open(tmp, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(BIRDS_CSV_HEADER)
+            writer.writerows(rows[1:])
+        os.replace(tmp, BIRDS_CSV_FILE)
+
+    # Rebuild replay dedup state and the known nests from the log
+    for row in rows[1:]:
+        if len(row) >= 2:
+            known_devices.add(row[1])
+        if len(row) >= 4 and row[3] != '':
+            _mark_seen(row[1], (row[3], row[2]))
+
+def _mark_seen(device_id, key):
+    keys, lookup = seen_detections.setdefault(device_id, (deque(), set()))
+    keys.append(key)
+    lookup.add(key)
+    if len(keys) > DEDUP_WINDOW:
+        lookup.discard(keys.popleft())
 
 def log_to_csv(device_id, firmware, event_type, ssid='', bssid='', rssi='', ip=''):
     """Log device event to CSV"""
@@ -67,17 +195,139 @@ def log_to_csv(device_id, firmware, event_type, ssid='', bssid='', rssi='', ip='
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             writer.writerow([timestamp, device_id, firmware, event_type, ssid, bssid, rssi, ip])
 
-def log_bird_detection(device_id, device_timestamp):
+def log_bird_detection(device_id, device_timestamp, seq=None):
     """Log bird detection to CSV"""
+    return log_bird_detections(device_id, [(device_timestamp, seq)])
+
+def _device_millis(device_timestamp):
+    try:
+        return int(device_timestamp)
+    except (TypeError, ValueError):
+        return None
+
+def event_times(events, received):
+    """Wall-clock time of each (device_timestamp, seq) event. The device sends
+    its millis() uptime, so the newest event is dated at `received` and older
+    ones of a buffered batch are moved back by the difference."""
+    millis = [_device_millis(device_timestamp) for device_timestamp, _ in events]
+    newest = max((m for m in millis if m is not None), default=None)
+    return [received - max(newest - m, 0) / 1000 if m is not None else received
+            for m in millis]
+
+def log_bird_detections(device_id, events, received=None):
+    """Log a batch of (device_timestamp, seq) detections with one write.
+    Returns the events that were not replays of already logged ones."""
+    global birds_log_version
+    times = event_times(events, received if received is not None else time.time())
     with csv_lock:
+        accepted, rows = [], []
+        for (device_timestamp, seq), when in zip(events, times):
+            if seq is not None:
+                key = (str(seq), str(device_timestamp))
+                known = seen_detections.get(device_id)
+                if known and key in known[1]:
+                    continue
+                _mark_seen(device_id, key)
+            accepted.append((device_timestamp, seq))
+            rows.append([datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:%M:%S'), device_id,
+                         device_timestamp, '' if seq is None else seq])
+        if not accepted:
+            return accepted
+
+        known_devices.add(device_id)
         with open(BIRDS_CSV_FILE, 'a', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            writer.writerow([timestamp, device_id, device_timestamp])
-
-# Initialize CSV on startup
-init_csv()
-init_birds_csv()
+            writer.writerows(rows)
+        birds_log_version += 1
+        if detection_store:
+            detection_store.append([row[0] for row in rows], device_id)
+    return accepted
+
+# Analytics over the birds log (optional, needs numpy); created in main() so
+# public workers do not get one, loaded on first query
+detection_store = None
+
+# Wire formats a public client can opt into with 'set_format'. The name is
+# the enabled options joined by '+', e.g. 'columnar+msgpack+deflate':
+#   columnar - history as columns with dictionary-encoded device ids
+#   msgpack  - MessagePack binary frame instead of JSON text
+#   deflate  - zlib-compressed binary frame
+# Clients that never ask get plain JSON ('json') as before.
+WIRE_OPTIONS = ('columnar', 'msgpack', 'deflate')
+client_formats = {}  # sid -> wire format, absent = 'json'
+formats_in_use = {'json'}
+
+def wire_format(options):
+    """Wire format name from requested options (msgpack only if installed)"""
+    enabled = [o for o in WIRE_OPTIONS if options.get(o) and (o != 'msgpack' or msgpack)]
+    return '+'.join(enabled) or 'json'
+
+def encode_payload(data, fmt):
+    """Encode for one wire format: JSON text (RawJSON) or a binary frame (bytes)"""
+    if 'msgpack' in fmt:
+        encoded = msgpack.packb(data, use_bin_type=True)
+    elif 'deflate' in fmt:
+        encoded = json.dumps(data, separators=(',', ':')).encode()
+    else:
+        # ensure_ascii keeps len() equal to the encoded size in bytes
+        return RawJSON(json.dumps(data, separators=(',', ':')))
+    if 'deflate' in fmt:
+        encoded = zlib.compress(encoded)
+    return encoded
+
+# Snapshot cache: encoded history/stats payloads per (name, log version, day,
+# wire format), built once and shared by all viewers until the next detection
+SNAPSHOT_CACHE_BYTES = 16 * 1024 * 1024
+snapshot_cache = OrderedDict()  # (name, version, day, fmt) -> RawJSON/bytes, least recently used first
+snapshot_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+snapshot_lock = threading.Lock()
+snapshot_build_lock = threading.Lock()
+
+def _snapshot_drop(key):
+    payload = snapshot_cache.pop(key)
+    snapshot_stats['bytes'] -= len(payload)
+
+def log_version():
+    """Birds log version for snapshot keys. A public worker learns about new
+    rows only from the bus (QoS 0, lost while reconnecting), so it also keys
+    on the size of the append-only log"""
+    if not in_public_worker:
+        return birds_log_version
+    try:
+        size = os.path.getsize(BIRDS_CSV_FILE)
+    except OSError:
+        size = 0
+    return (birds_log_version, size)
+
+def snapshot(name, build, fmt='json'):
+    """Encoded payload of build() for the current birds log version"""
+    key = (name, log_version(), datetime.now().strftime('%Y-%m-%d'), fmt)
+    with snapshot_lock:
+        payload = snapshot_cache.get(key)
+        if payload is not None:
+            snapshot_cache.move_to_end(key)
+            snapshot_stats['hits'] += 1
+            return payload
+    # Viewers asking at the same time wait for a single build
+    with snapshot_build_lock:
+        with snapshot_lock:
+            payload = snapshot_cache.get(key)
+            if payload is not None:
+                snapshot_cache.move_to_end(key)
+                snapshot_stats['hits'] += 1
+                return payload
+        payload = encode_payload(build(), fmt)
+        with snapshot_lock:
+            snapshot_stats['misses'] += 1
+            # Older versions can never be hit again
+            for stale in [k for k in snapshot_cache if k[1] < key[1]]:
+                _snapshot_drop(stale)
+            snapshot_cache[key] = payload
+            snapshot_stats['bytes'] += len(payload)
+            while snapshot_stats['bytes'] > SNAPSHOT_CACHE_BYTES and len(snapshot_cache) > 1:
+                _snapshot_drop(next(iter(snapshot_cache)))
+                snapshot_stats['evictions'] += 1
+    return payload
 
 # Flask routes
 @app.route('/')
@@ -131,6 +381,58 @@ def birds_data():
                 logs.append(','.join(row))
     return jsonify({'logs': logs})
 
+@app.route('/api/latency')
+def api_latency():
+    return jsonify({'ingest': latency_summary()})
+
+@app.route('/api/public_rooms')
+def api_public_rooms():
+    if PUBLIC_WORKERS:
+        # Clients and rooms live in the worker processes
+        return jsonify({'workers': {port: {'pid': proc.pid, 'alive': proc.is_alive()}
+                                    for port, proc in public_workers.items()}})
+    with rooms_lock:
+        return jsonify({'clients': len(public_subscriptions), 'rooms': room_stats})
+
+@app.route('/api/analytics/<query>')
+def api_analytics(query):
+    """inter_arrival | busiest_hours | daily_trend, filtered by
+    ?device=ID&since=YYYY-MM-DD&until=YYYY-MM-DD (until is exclusive)"""
+    if detection_store is None:
+        return jsonify({'error': 'analytics needs numpy'}), 503
+    queries = {
+        'inter_arrival': detection_store.inter_arrival,
+        'busiest_hours': detection_store.busiest_hours,
+        'daily_trend': detection_store.daily_trend,
+    }
+    if query not in queries:
+        return jsonify({'error': f'unknown query, use one of {sorted(queries)}'}), 404
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        params = {
+            'device': request.args.get('device'),
+            'since': analytics.day_epoch(since) if since else None,
+            'until': analytics.day_epoch(until) if until else None,
+        }
+    except ValueError:
+        return jsonify({'error': 'since/until must be YYYY-MM-DD'}), 400
+
+    started = time.perf_counter()
+    if not detection_store.loaded:
+        with csv_lock:
+            if not detection_store.loaded:
+                detection_store.load()
+    result = queries[query](**params)
+    result['query_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return jsonify(result)
+
+@app.route('/api/snapshot_cache')
+def api_snapshot_cache():
+    with snapshot_lock:
+        return jsonify(dict(snapshot_stats, entries=len(snapshot_cache), version=birds_log_version,
+                            limit_bytes=SNAPSHOT_CACHE_BYTES))
+
 # OTA Functions
 def find_free_port(start=40000, end=45000):
     """Find a free port in the specified range"""
@@ -299,6 +601,60 @@ def get_birds_history():
                         })
     return history
 
+def columnar_history(history):
+    """History rows as columns: device ids as indexes into 'devices',
+    'time' as wall-clock seconds (first absolute, then deltas from the previous row)"""
+    devices, codes = [], {}
+    device_column, time_column, device_timestamps = [], [], []
+    day_starts = {}
+    previous = 0
+    for row in history:
+        ts = row['timestamp']
+        day = ts[:10]
+        try:
+            if day not in day_starts:
+                day_starts[day] = int((datetime.strptime(day, '%Y-%m-%d') - datetime(1970, 1, 1)).total_seconds())
+            seconds = day_starts[day] + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19])
+        except ValueError:
+            continue  # Malformed row in birds.csv, leave it out
+        time_column.append(seconds - previous)
+        previous = seconds
+        code = codes.get(row['device_id'])
+        if code is None:
+            code = codes[row['device_id']] = len(devices)
+            devices.append(row['device_id'])
+        device_column.append(code)
+        value = row['device_timestamp']
+        device_timestamps.append(int(value) if value.isdigit() else value)
+    return {
+        'devices': devices,
+        'time': time_column,
+        'device': device_column,
+        'device_timestamp': device_timestamps
+    }
+
+def stats_payload(fmt='json'):
+    """Cached encoded stats payload"""
+    def build():
+        today_count, total_count = get_birds_stats()
+        return {
+            'prulety_dnes': today_count,
+            'celkove_prulety': total_count
+        }
+    return snapshot('stats', build, fmt)
+
+def history_payload(fmt='json'):
+    """Cached encoded history payload (stats + full history)"""
+    def build():
+        today_count, total_count = get_birds_stats()
+        history = get_birds_history()
+        return {
+            'prulety_dnes': today_count,
+            'celkove_prulety': total_count,
+            'historie': columnar_history(history) if 'columnar' in fmt else history
+        }
+    return snapshot('history', build, fmt)
+
 # Public API Routes
 @public_app.route('/')
 def public_index():
@@ -307,62 +663,183 @@ def public_index():
         'message': 'Public Bird Detection API - Socket.IO only',
         'version': '1.0',
         'socketio': {
-            'port': 4120,
+            'port': PUBLIC_PORT,
             'events': {
                 'connect': 'Připojit se k real-time detekcím - automaticky dostanete aktuální statistiky',
                 'get_history': 'Vyžádat kompletní historii a statistiky',
                 'get_stats': 'Vyžádat pouze statistiky',
+                'subscribe': 'Odebírat jen vybrané budky: {"device_ids": ["ESP32_ORECH", ...]} '
+                             f'- jen známé budky, nejvýš {MAX_SUBSCRIPTIONS}; ostatní vrátí v "rejected"',
+                'unsubscribe': 'Zrušit odběr budek: {"device_ids": [...]} (bez budek = opět všechny)',
+                'set_format': 'Kompaktní formát: {"columnar": true, "msgpack": true, "deflate": true} '
+                              '- historie po sloupcích, binární MessagePack rámce, zlib; bez voleb = JSON',
                 'bird_detection': 'Event: Real-time detekce ptáka (automaticky posílá server)'
             }
         },
         'documentation': 'https://github.com/yourproject/api-docs'
     })
 
+# Public Socket.IO rooms: clients with a non-JSON wire format sit in a
+# per-format copy of each room, so every format is encoded once per event
+def format_room(room, fmt):
+    return room if fmt == 'json' else f"{room}|{fmt}"
+
+def _client_format():
+    return client_formats.get(request.sid, 'json')
+
+def _client_rooms(sid):
+    with rooms_lock:
+        device_ids = public_subscriptions.get(sid, set())
+    return [nest_room(d) for d in device_ids] if device_ids else [ALL_NESTS_ROOM]
+
+def _room_join(room):
+    room = format_room(room, _client_format())
+    join_room(room)
+    with rooms_lock:
+        room_stats.setdefault(room, {'members': 0, 'sent': 0})['members'] += 1
+
+def _room_release(room):
+    """One member less; empty rooms are dropped (call with rooms_lock held)"""
+    stats = room_stats.get(room)
+    if stats:
+        stats['members'] -= 1
+        if stats['members'] <= 0:
+            del room_stats[room]
+
+def _room_leave(room):
+    room = format_room(room, _client_format())
+    leave_room(room)
+    with rooms_lock:
+        _room_release(room)
+
+def _room_emit(event, data, rooms):
+    """Emit to rooms (each wire format copy of them), skipping empty ones;
+    the payload is encoded at most once per wire format"""
+    for fmt in list(formats_in_use):
+        payload = None
+        for room in rooms:
+            target = format_room(room, fmt)
+            with rooms_lock:
+                stats = room_stats.get(target)
+                if not stats or stats['members'] <= 0:
+                    continue
+                stats['sent'] += stats['members']
+            if payload is None:
+                payload = encode_payload(data, fmt)
+            public_socketio.emit(event, payload, to=target)
+
 # Public Socket.IO handlers
 @public_socketio.on('connect')
 def public_handle_connect():
     print('[Public API] Client connected')
-    # Send current stats on connect
-    today_count, total_count = get_birds_stats()
-    public_socketio.emit('stats', {
-        'prulety_dnes': today_count,
-        'celkove_prulety': total_count
-    })
+    with rooms_lock:
+        public_subscriptions[request.sid] = set()
+    _room_join(ALL_NESTS_ROOM)
+    # Send current stats on connect (only to this client)
+    emit('stats', stats_payload())
 
 @public_socketio.on('disconnect')
 def public_handle_disconnect():
     print('[Public API] Client disconnected')
+    fmt = client_formats.pop(request.sid, 'json')
+    with rooms_lock:
+        device_ids = public_subscriptions.pop(request.sid, set())
+    rooms = [nest_room(d) for d in device_ids] if device_ids else [ALL_NESTS_ROOM]
+    with rooms_lock:
+        for room in rooms:
+            _room_release(format_room(room, fmt))
+
+def _requested_device_ids(data):
+    """device_ids from a subscribe/unsubscribe payload, empty if malformed"""
+    if not isinstance(data, dict) or not isinstance(data.get('device_ids'), list):
+        return set()
+    return {str(d) for d in data['device_ids']}
+
+@public_socketio.on('subscribe')
+def public_handle_subscribe(data):
+    """Client wants detections only from selected nests (known ones only)"""
+    device_ids = _requested_device_ids(data)
+    rejected = {d for d in device_ids if not is_known_device(d)}
+    with rooms_lock:
+        current = public_subscriptions.setdefault(request.sid, set())
+        free = max(MAX_SUBSCRIPTIONS - len(current), 0)
+        candidates = sorted(device_ids - rejected - current)
+        added = candidates[:free]
+        rejected.update(candidates[free:])
+        was_all = not current
+        current.update(added)
+    if added and was_all:
+        _room_leave(ALL_NESTS_ROOM)
+    for device_id in added:
+        _room_join(nest_room(device_id))
+    response = {'device_ids': sorted(current)}
+    if rejected:
+        response['rejected'] = sorted(rejected)
+    emit('subscribed', response)
+
+@public_socketio.on('unsubscribe')
+def public_handle_unsubscribe(data):
+    """Client stops following selected nests; with none left it gets all again"""
+    device_ids = _requested_device_ids(data)
+    with rooms_lock:
+        current = public_subscriptions.setdefault(request.sid, set())
+        removed = device_ids & current
+        current -= removed
+        now_all = removed and not current
+    for device_id in removed:
+        _room_leave(nest_room(device_id))
+    if now_all:
+        _room_join(ALL_NESTS_ROOM)
+    emit('subscribed', {'device_ids': sorted(current)})
+
+@public_socketio.on('set_format')
+def public_handle_set_format(data):
+    """Client opts into a compact wire format (or back to JSON with no options)"""
+    fmt = wire_format(data or {})
+    rooms = _client_rooms(request.sid)
+    for room in rooms:
+        _room_leave(room)
+    if fmt == 'json':
+        client_formats.pop(request.sid, None)
+    else:
+        client_formats[request.sid] = fmt
+        formats_in_use.add(fmt)
+    for room in rooms:
+        _room_join(room)
+    # Always plain JSON, so the client can tell what it got (msgpack may be missing)
+    emit('format', {option: option in fmt.split('+') for option in WIRE_OPTIONS})
 
 @public_socketio.on('get_stats')
 def public_handle_get_stats():
     """Client requests only statistics"""
-    today_count, total_count = get_birds_stats()
-    public_socketio.emit('stats', {
-        'prulety_dnes': today_count,
-        'celkove_prulety': total_count
-    })
+    emit('stats', stats_payload(_client_format()))
 
 @public_socketio.on('get_history')
 def public_handle_get_history():
     """Client requests full history"""
-    today_count, total_count = get_birds_stats()
-    history = get_birds_history()
-
-    public_socketio.emit('history', {
-        'prulety_dnes': today_count,
-        'celkove_prulety': total_count,
-        'historie': history
-    })
+    emit('history', history_payload(_client_format()))
 
-def notify_public_detection(device_id, timestamp):
-    """Notify public API clients about new detection"""
-    today_count, total_count = get_birds_stats()
-    public_socketio.emit('bird_detection', {
+def notify_public_detection(device_id, timestamps):
+    """Notify public API clients following this nest (or all nests);
+    a batch of detections goes out as one event"""
+    data = {
         'device_id': device_id,
-        'timestamp': timestamp,
-        'prulety_dnes': today_count,
-        'celkove_prulety': total_count
-    })
+        'timestamp': timestamps[-1],
+        **json.loads(stats_payload())
+    }
+    if len(timestamps) > 1:
+        data['count'] = len(timestamps)
+        data['timestamps'] = timestamps
+    if PUBLIC_WORKERS:
+        # Published once, every worker emits to its own clients
+        mqtt_client.publish(PUBLIC_BUS_TOPIC, json.dumps(data))
+        return
+    emit_public_detection(data)
+
+def emit_public_detection(data):
+    """Emit a detection to the public rooms of this process"""
+    # A client is either in ALL_NESTS_ROOM or in nest rooms, never both
+    _room_emit('bird_detection', data, [ALL_NESTS_ROOM, nest_room(data['device_id'])])
 
 # MQTT Handlers
 def on_connect(client, userdata, flags, rc):
@@ -381,6 +858,7 @@ def on_connect(client, userdata, flags, rc):
 
 def on_message(client, userdata, msg):
     """Callback when MQTT message is received"""
+    rx_time = time.time()
     try:
         topic_parts = msg.topic.split('/')
         if len(topic_parts) < 3:
@@ -453,36 +931,56 @@ def on_message(client, userdata, msg):
                 'status': 'received'
             }))
 
-        # Handle bird detection
+        # Handle bird detection: one event, or a batch of buffered events
+        # {"events": [{"timestamp": ..., "seq": ...}, ...]} after a reconnect
         elif message_type == 'bird_detection':
             payload = data.get('payload', data)
-            device_timestamp = payload.get('timestamp', 0)
+            if isinstance(payload.get('events'), list):
+                batch = [e for e in payload['events'] if isinstance(e, dict)]
+            else:
+                batch = [payload]
+            events = [(e.get('timestamp', 0), e.get('seq')) for e in batch]
+            # Same id as the NVR derives for this message (last event of a batch)
+            last = batch[-1] if batch else {}
+            trace_id = str(payload.get('trace_id')
+                           or detection_trace_id(device_id, last.get('timestamp'), last.get('seq')))
 
-            print(f"[MQTT] Bird detection from {device_id} at {device_timestamp}")
+            print(f"[MQTT] Bird detection from {device_id}: {len(events)} event(s) (trace {trace_id})")
 
-            # Log to birds CSV
-            log_bird_detection(device_id, device_timestamp)
+            # Log to birds CSV, replays are dropped
+            accepted = log_bird_detections(device_id, events, rx_time)
 
             # Update last seen
             if device_id in connected_devices:
                 connected_devices[device_id]['last_seen'] = datetime.now()
 
-            # Notify admin about bird detection
-            notify_admin({
-                'type': 'bird_detection',
-                'device_id': device_id,
-                'timestamp': device_timestamp
-            })
+            if accepted:
+                timestamps = [device_timestamp for device_timestamp, _ in accepted]
+                # Notify admin about bird detection
+                notify_admin({
+                    'type': 'bird_detection',
+                    'device_id': device_id,
+                    'timestamp': timestamps[-1],
+                    'count': len(timestamps),
+                    'timestamps': timestamps
+                })
 
-            # Notify public API clients
-            notify_public_detection(device_id, device_timestamp)
+                # Notify public API clients
+                notify_public_detection(device_id, timestamps)
 
-            # Send acknowledgment
+            # Send acknowledgment (replays too, so the device can drop them)
             response_topic = f"{MQTT_BASE_TOPIC}/{device_id}/response"
-            client.publish(response_topic, json.dumps({
+            ack = {
                 'type': 'ack',
-                'status': 'received'
-            }))
+                'status': 'received',
+                'trace_id': trace_id
+            }
+            seqs = [seq for _, seq in events if seq is not None]
+            if seqs:
+                ack['seqs'] = seqs
+                ack['duplicates'] = len(events) - len(accepted)
+            client.publish(response_topic, json.dumps(ack))
+            record_ingest_latency(trace_id, device_id, rx_time)
 
         # Handle OTA progress
         elif message_type == 'ota_progress':
@@ -539,10 +1037,17 @@ def send_to_iot_device(device_id, payload):
     else:
         print(f"[MQTT] Device {device_id} not connected")
 
+def new_mqtt_client():
+    """paho client with the v1 callback API on both paho 1.x and 2.x"""
+    try:
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+        return mqtt.Client()
+
 def start_mqtt_client():
     """Start MQTT client"""
     global mqtt_client
-    mqtt_client = mqtt.Client()
+    mqtt_client = new_mqtt_client()
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.on_disconnect = on_disconnect
@@ -557,20 +1062,106 @@ def start_mqtt_client():
     except Exception as e:
         print(f"[MQTT] Failed to connect: {e}")
 
+# Public API worker processes
+def on_public_bus_connect(client, userdata, flags, rc):
+    if rc == 0:
+        client.subscribe(PUBLIC_BUS_TOPIC)
+    else:
+        print(f"[Public API] Bus connection failed with code {rc}")
+
+def on_public_bus_message(client, userdata, msg):
+    """A detection published by the ingest process"""
+    global birds_log_version
+    try:
+        data = json.loads(msg.payload.decode())
+    except ValueError:
+        print(f"[Public API] Invalid bus message: {msg.payload}")
+        return
+    # The ingest process has already written the row, drop cached snapshots
+    with csv_lock:
+        birds_log_version += 1
+    if isinstance(data, dict) and 'device_id' in data:
+        known_devices.add(data['device_id'])
+    emit_public_detection(data)
+
+def public_worker_main(port, broker, broker_port, username, password, devices):
+    """Entry point of one public API worker process"""
+    global MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, mqtt_client, in_public_worker
+    MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD = broker, broker_port, username, password
+    in_public_worker = True
+    # Nests known to the ingest process; new ones arrive with their detections
+    known_devices.update(devices)
+
+    mqtt_client = new_mqtt_client()
+    mqtt_client.on_connect = on_public_bus_connect
+    mqtt_client.on_message = on_public_bus_message
+    mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    mqtt_client.loop_start()
+
+    # Exit together with the ingest process, even if it was killed
+    parent = os.getppid()
+    def watch_parent():
+        while os.getppid() == parent:
+            time.sleep(2)
+        os._exit(0)
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+    print(f"[Public API] Worker {os.getpid()} started on port {port}")
+    public_socketio.run(public_app, host='0.0.0.0', port=port, debug=False, use_reloader=False,
+                        allow_unsafe_werkzeug=True)
+
+def start_public_worker(port):
+    # spawn: no threads or sockets of this process are inherited
+    ctx = multiprocessing.get_context('spawn')
+    proc = ctx.Process(target=public_worker_main, name=f"public-{port}", daemon=True,
+                       args=(port, MQTT_BROKER, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD,
+                             sorted(known_devices | set(connected_devices))))
+    proc.start()
+    public_workers[port] = proc
+
+def watch_public_workers():
+    """Restart public workers that exited"""
+    while True:
+        time.sleep(5)
+        for port, proc in list(public_workers.items()):
+            if not proc.is_alive():
+                print(f"[Public API] Worker on port {port} exited ({proc.exitcode}), restarting")
+                start_public_worker(port)
+
 # Main entry point
-if __name__ == '__main__':
+def main():
+    global detection_store
     print("Starting servers...")
 
+    # Initialize CSV logs (only here: public workers re-import this module)
+    init_csv()
+    init_birds_csv()
+    if analytics:
+        detection_store = analytics.DetectionStore(BIRDS_CSV_FILE)
+
     # Start MQTT client
     start_mqtt_client()
 
-    # Start public API server in separate thread
-    def run_public_api():
-        public_socketio.run(public_app, host='0.0.0.0', port=4120, debug=False, use_reloader=False)
+    if PUBLIC_WORKERS:
+        for i in range(PUBLIC_WORKERS):
+            start_public_worker(PUBLIC_PORT + i)
+        threading.Thread(target=watch_public_workers, daemon=True).start()
+        print(f"[Public API] Started {PUBLIC_WORKERS} workers on ports "
+              f"{PUBLIC_PORT}-{PUBLIC_PORT + PUBLIC_WORKERS - 1}")
+    else:
+        # Start public API server in separate thread
+        def run_public_api():
+            public_socketio.run(public_app, host='0.0.0.0', port=PUBLIC_PORT, debug=False,
+                                use_reloader=False, allow_unsafe_werkzeug=True)
 
-    public_thread = threading.Thread(target=run_public_api, daemon=True)
-    public_thread.start()
-    print(f"[Public API] Started on port 4120")
+        public_thread = threading.Thread(target=run_public_api, daemon=True)
+        public_thread.start()
+        print(f"[Public API] Started on port {PUBLIC_PORT}")
 
     # Start Flask + SocketIO server (blocking)
-    socketio.run(app, host='0.0.0.0', port=6235, debug=True, use_reloader=False)
+    socketio.run(app, host='0.0.0.0', port=6235, debug=True, use_reloader=False,
+                 allow_unsafe_werkzeug=True)
+
+if __name__ == '__main__':
+    main()
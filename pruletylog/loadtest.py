@@ -0,0 +1,466 @@
+"""
+Load test for app.py: simulated ESP32 fleet + Socket.IO viewers
+================================================================
+
+Starts a minimal in-process MQTT broker (stand-in for Mosquitto), runs app.py
+against it in a subprocess, then simulates N devices doing
+register/status/data/bird_detection and opens M public (4120) and admin (6235)
+Socket.IO clients. Reports ack latency, broadcast delivery latency
+percentiles and app CPU/memory.
+
+    python loadtest.py --devices 50 --viewers 100 --admins 2 --duration 60
+    python loadtest.py --devices 200 --rate 0.2 --json results.json
+    python loadtest.py --viewers 400 --public-workers 4
+
+Needs python-socketio[client] for the viewers.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+PUBLIC_PORT = 4120
+ADMIN_PORT = 6235
+BASE_TOPIC = "prulety"
+
+# MQTT 3.1.1 packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+# MQTT codec
+def _mqtt_str(value):
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack(">H", len(data)) + data
+
+def _packet(ptype, flags, body):
+    length = len(body)
+    header = bytearray([(ptype << 4) | flags])
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+async def _read_packet(reader):
+    """Read one packet -> (type, flags, body)"""
+    first = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    body = await reader.readexactly(length) if length else b""
+    return first >> 4, first & 0x0F, body
+
+def _parse_publish(flags, body):
+    topic_len = struct.unpack_from(">H", body)[0]
+    topic = body[2:2 + topic_len].decode()
+    pos = 2 + topic_len
+    packet_id = None
+    if (flags >> 1) & 0x03:
+        packet_id = struct.unpack_from(">H", body, pos)[0]
+        pos += 2
+    return topic, packet_id, body[pos:]
+
+def publish_packet(topic, payload):
+    return _packet(PUBLISH, 0, _mqtt_str(topic) + payload)
+
+def topic_matches(pattern, topic):
+    pparts, tparts = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(pparts):
+        if part == "#":
+            return True
+        if i >= len(tparts) or (part != "+" and part != tparts[i]):
+            return False
+    return len(pparts) == len(tparts)
+
+
+class MiniBroker:
+    """Minimal MQTT 3.1.1 broker: QoS 0 fan-out, QoS 1 acked, no retain/persistence"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.sessions = {}  # writer -> [topic filters]
+        self.subscribed = asyncio.Event()  # app.py subscribed to detections
+        self.messages_in = 0
+        self.messages_out = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self.sessions):
+            writer.close()
+        # Let session handlers see EOF and finish before the loop goes away
+        while self.sessions:
+            await asyncio.sleep(0.05)
+
+    def route(self, topic, payload):
+        packet = publish_packet(topic, payload)
+        for writer, filters in list(self.sessions.items()):
+            if any(topic_matches(f, topic) for f in filters):
+                writer.write(packet)
+                self.messages_out += 1
+
+    async def _handle(self, reader, writer):
+        self.sessions[writer] = []
+        try:
+            while True:
+                ptype, flags, body = await _read_packet(reader)
+                if ptype == CONNECT:
+                    writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+                elif ptype == PUBLISH:
+                    topic, packet_id, payload = _parse_publish(flags, body)
+                    self.messages_in += 1
+                    if packet_id is not None:
+                        writer.write(_packet(PUBACK, 0, struct.pack(">H", packet_id)))
+                    self.route(topic, payload)
+                elif ptype == SUBSCRIBE:
+                    packet_id = struct.unpack_from(">H", body)[0]
+                    pos, granted = 2, bytearray()
+                    while pos < len(body):
+                        topic_len = struct.unpack_from(">H", body, pos)[0]
+                        topic = body[pos + 2:pos + 2 + topic_len].decode()
+                        pos += 3 + topic_len
+                        self.sessions[writer].append(topic)
+                        granted.append(0)
+                        if topic == f"{BASE_TOPIC}/+/bird_detection":
+                            self.subscribed.set()
+                    writer.write(_packet(SUBACK, 0, struct.pack(">H", packet_id) + bytes(granted)))
+                elif ptype == UNSUBSCRIBE:
+                    packet_id = struct.unpack_from(">H", body)[0]
+                    pos = 2
+                    while pos < len(body):
+                        topic_len = struct.unpack_from(">H", body, pos)[0]
+                        topic = body[pos + 2:pos + 2 + topic_len].decode()
+                        pos += 2 + topic_len
+                        if topic in self.sessions[writer]:
+                            self.sessions[writer].remove(topic)
+                    writer.write(_packet(UNSUBACK, 0, struct.pack(">H", packet_id)))
+                elif ptype == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b""))
+                elif ptype == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.pop(writer, None)
+            writer.close()
+
+
+# Statistics
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))] * 1000, 2)
+
+    return {'count': len(ordered), 'p50_ms': pct(50), 'p90_ms': pct(90),
+            'p99_ms': pct(99), 'max_ms': round(ordered[-1] * 1000, 2)}
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}  # device timestamp (unique per run) -> send time
+        self.ack_latency = []
+        self.public_latency = []
+        self.admin_latency = []
+        self.counts = {'detections': 0, 'acks': 0, 'public_delivered': 0,
+                       'admin_delivered': 0, 'other_messages': 0}
+
+    def delivered(self, kind, device_timestamp):
+        now = time.time()
+        sent = self.sent.get(device_timestamp)
+        if sent is None:
+            return
+        with self.lock:
+            getattr(self, f"{kind}_latency").append(now - sent)
+            self.counts[f"{kind}_delivered"] += 1
+
+
+# Simulated ESP32
+class Device:
+    """One simulated ESP32 speaking MQTT to the broker"""
+
+    _detection_ids = itertools.count(1)
+
+    def __init__(self, device_id, port, results, args):
+        self.device_id = device_id
+        self.port = port
+        self.results = results
+        self.args = args
+        self.pending = {}  # trace_id -> send time
+        self.reader = None
+        self.writer = None
+
+    def _publish(self, kind, data):
+        topic = f"{BASE_TOPIC}/{self.device_id}/{kind}"
+        self.writer.write(publish_packet(topic, json.dumps(data).encode()))
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        body = _mqtt_str("MQTT") + bytes([4, 0x02]) + struct.pack(">H", 60) + _mqtt_str(self.device_id)
+        self.writer.write(_packet(CONNECT, 0, body))
+        await _read_packet(self.reader)
+        topic = f"{BASE_TOPIC}/{self.device_id}/response"
+        self.writer.write(_packet(SUBSCRIBE, 2, struct.pack(">H", 1) + _mqtt_str(topic) + b"\x00"))
+
+    async def _read_responses(self):
+        while True:
+            ptype, flags, body = await _read_packet(self.reader)
+            if ptype != PUBLISH:
+                continue
+            _, _, payload = _parse_publish(flags, body)
+            data = json.loads(payload)
+            sent = self.pending.pop(data.get('trace_id'), None)
+            with self.results.lock:
+                if sent is not None:
+                    self.results.ack_latency.append(time.time() - sent)
+                    self.results.counts['acks'] += 1
+                else:
+                    self.results.counts['other_messages'] += 1
+
+    async def _every(self, interval, action):
+        # Spread devices over the interval so they don't fire in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            action()
+            await asyncio.sleep(interval)
+
+    def _status(self):
+        self._publish('status', {'firmware': 'loadtest'})
+
+    def _data(self):
+        self._publish('data', {'payload': {
+            'ssid': 'loadtest', 'bssid': '00:00:00:00:00:00',
+            'rssi': random.randint(-90, -40), 'ip': '127.0.0.1',
+            'timestamp': int(time.monotonic() * 1000)}})
+
+    async def _detections(self):
+        while True:
+            # Poisson arrivals at --rate detections per second per device
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            detection_id = next(self._detection_ids)
+            trace_id = f"{self.device_id}-{detection_id}"
+            now = time.time()
+            self.pending[trace_id] = now
+            self.results.sent[detection_id] = now
+            with self.results.lock:
+                self.results.counts['detections'] += 1
+            self._publish('bird_detection', {'payload': {'timestamp': detection_id,
+                                                         'trace_id': trace_id}})
+
+    async def run(self):
+        await self._connect()
+        self._publish('register', {'firmware': 'loadtest'})
+        try:
+            await asyncio.gather(
+                self._read_responses(),
+                self._every(self.args.status_interval, self._status),
+                self._every(self.args.data_interval, self._data),
+                self._detections(),
+            )
+        finally:
+            self.writer.close()
+
+
+# Socket.IO viewers
+def decode_compact(data):
+    """Binary frame of the columnar+msgpack+deflate wire format -> dict"""
+    import msgpack
+    return msgpack.unpackb(zlib.decompress(data)) if isinstance(data, bytes) else data
+
+
+def start_viewers(results, count, ports, admin, compact=False):
+    import socketio
+
+    clients = []
+    for i in range(count):
+        port = ports[i % len(ports)]
+        client = socketio.Client(reconnection=False)
+        if admin:
+            def on_notification(data):
+                if data.get('type') == 'bird_detection':
+                    results.delivered('admin', data.get('timestamp'))
+            client.on('notification', on_notification)
+        else:
+            def on_detection(data):
+                results.delivered('public', decode_compact(data).get('timestamp'))
+            client.on('bird_detection', on_detection)
+        client.connect(f"http://127.0.0.1:{port}", transports=['websocket'])
+        if compact and not admin:
+            client.emit('set_format', {'columnar': True, 'msgpack': True, 'deflate': True})
+        clients.append(client)
+    return clients
+
+
+# Process sampling (Linux /proc)
+class ProcessSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.cpu = []
+        self.rss = []
+        self._last = None
+
+    def _cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def sample(self):
+        try:
+            cpu = self._cpu_seconds()
+            with open(f"/proc/{self.pid}/status") as f:
+                rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS'))
+        except (OSError, StopIteration):
+            return
+        now = time.monotonic()
+        if self._last:
+            self.cpu.append((cpu - self._last[1]) / (now - self._last[0]) * 100)
+        self._last = (now, cpu)
+        self.rss.append(rss / 1024)
+
+    def summary(self):
+        if not self.cpu:
+            return {}
+        return {'cpu_avg_pct': round(sum(self.cpu) / len(self.cpu), 1),
+                'cpu_max_pct': round(max(self.cpu), 1),
+                'rss_max_mb': round(max(self.rss), 1),
+                'rss_end_mb': round(self.rss[-1], 1)}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_app(broker_port, workdir, public_workers=0):
+    """Run app.py against the stand-in broker; CSV logs go to workdir"""
+    bootstrap = (
+        "import sys; sys.path.insert(0, {app_dir!r}); import app; "
+        "app.MQTT_BROKER = '127.0.0.1'; app.MQTT_PORT = {port}; "
+        "app.PUBLIC_WORKERS = {workers}; app.main()"
+    ).format(app_dir=str(APP_DIR), port=broker_port, workers=public_workers)
+    return subprocess.Popen([sys.executable, "-c", bootstrap], cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def run(args):
+    results = Results()
+    broker = MiniBroker(port=args.broker_port)
+    await broker.start()
+    print(f"[LoadTest] Broker on 127.0.0.1:{broker.port}")
+
+    workdir = tempfile.mkdtemp(prefix="pruletylog_loadtest_")
+    proc = spawn_app(broker.port, workdir, args.public_workers)
+    public_ports = [PUBLIC_PORT + i for i in range(max(args.public_workers, 1))]
+    loop = asyncio.get_running_loop()
+    ready = await loop.run_in_executor(
+        None, lambda: all(wait_for_port(port) for port in public_ports + [ADMIN_PORT]))
+    if not ready:
+        proc.kill()
+        sys.exit("[LoadTest] app.py did not open its ports")
+    await asyncio.wait_for(broker.subscribed.wait(), timeout=30)
+    print(f"[LoadTest] app.py running (pid {proc.pid}, workdir {workdir})")
+
+    viewers = await loop.run_in_executor(
+        None, lambda: start_viewers(results, args.viewers, public_ports, admin=False, compact=args.compact)
+        + start_viewers(results, args.admins, [ADMIN_PORT], admin=True))
+    print(f"[LoadTest] {args.viewers} public + {args.admins} admin viewers connected")
+
+    devices = [Device(f"LOADTEST_{i:04d}", broker.port, results, args)
+               for i in range(args.devices)]
+    tasks = [asyncio.create_task(d.run()) for d in devices]
+    sampler = ProcessSampler(proc.pid)
+
+    print(f"[LoadTest] {args.devices} devices for {args.duration}s...")
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        sampler.sample()
+        await asyncio.sleep(1)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Let in-flight acks and broadcasts arrive
+    await asyncio.sleep(2)
+    sampler.sample()
+
+    for client in viewers:
+        client.disconnect()
+    proc.terminate()
+    proc.wait(timeout=10)
+    await broker.stop()
+
+    return {
+        'config': {'devices': args.devices, 'viewers': args.viewers, 'admins': args.admins,
+                   'duration': args.duration, 'rate': args.rate,
+                   'public_workers': args.public_workers},
+        'counts': {**results.counts, 'broker_in': broker.messages_in,
+                   'broker_out': broker.messages_out},
+        'ack_latency': percentiles(results.ack_latency),
+        'public_delivery_latency': percentiles(results.public_latency),
+        'admin_delivery_latency': percentiles(results.admin_latency),
+        'app_process': sampler.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for pruletylog/app.py")
+    parser.add_argument('--devices', type=int, default=20, help="simulated ESP32 devices")
+    parser.add_argument('--viewers', type=int, default=20, help="public Socket.IO clients (port 4120)")
+    parser.add_argument('--admins', type=int, default=1, help="admin Socket.IO clients (port 6235)")
+    parser.add_argument('--duration', type=int, default=30, help="seconds of load")
+    parser.add_argument('--rate', type=float, default=0.1, help="detections per second per device")
+    parser.add_argument('--status-interval', type=float, default=30, help="seconds between status messages")
+    parser.add_argument('--data-interval', type=float, default=60, help="seconds between data messages")
+    parser.add_argument('--public-workers', type=int, default=0,
+                        help="app.PUBLIC_WORKERS; viewers are spread over the worker ports")
+    parser.add_argument('--compact', action='store_true',
+                        help="viewers use the columnar+msgpack+deflate wire format (needs msgpack)")
+    parser.add_argument('--broker-port', type=int, default=0, help="stand-in broker port (0 = any free)")
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
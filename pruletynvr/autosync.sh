@@ -5,14 +5,19 @@ FTP_HOST="host"
 FTP_USER="user"
 FTP_PASS="pass"
 REMOTE_DIR="/www/nvr"
+# NVR z tohoto záznamu měří, kdy je klip venku (viz SYNC_LOG v nvr.py)
+SYNC_LOG="$(dirname "$LOCAL_DIR")/nvr_state/sync.log"
+mkdir -p "$(dirname "$SYNC_LOG")"
 
 inotifywait -m -r -e create -e moved_to "$LOCAL_DIR" | while read path action file
 do
     echo "Nový soubor: $file – synchronizuji..."
+    SYNC_START=$(date +%s.%N)
 
     lftp -u "$FTP_USER","$FTP_PASS" ftp://"$FTP_HOST" <<EOF
-    mirror -R --only-newer --parallel=4 "$LOCAL_DIR" "$REMOTE_DIR"
+    mirror -R --only-newer --parallel=4 --exclude-glob "*.part" "$LOCAL_DIR" "$REMOTE_DIR"
     quit
 EOF
 
+    echo "$SYNC_START $(date +%s.%N)" >> "$SYNC_LOG"
 done
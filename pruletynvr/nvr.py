@@ -5,8 +5,14 @@ NVR – multi-kamera, kruhový buffer v RAM + detekce průletu přes MQTT
 Konfigurace: conf.yaml
 """
 
-import sys, time, json, shutil, signal, logging, threading, tempfile
+import os, re, sys, time, json, shutil, signal, logging, threading, tempfile, hashlib, struct, uuid, zlib
+import asyncio
+import atexit
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 import subprocess
 import paho.mqtt.client as mqtt
@@ -24,13 +30,75 @@ MQTT_BROKER   = "ip"
 MQTT_PORT     = 1883
 MQTT_USERNAME = "user"
 MQTT_PASSWORD = "pass"
+# Detekce všech budek jedním wildcard odběrem; topic kamery v conf.yaml,
+# který tomuto tvaru neodpovídá, se odebírá zvlášť
+MQTT_BASE_TOPIC      = "prulety"
+MQTT_DETECTION_TOPIC = f"{MQTT_BASE_TOPIC}/+/bird_detection"
 
 SEGMENT_DURATION   = 3
 PRE_BUFFER_SEC     = 15
 POST_DETECTION_SEC = 15
 
+# Watchdog ffmpeg: bez posunu v -progress / bez nového segmentu → restart
+STALL_TIMEOUT_SEC    = 6      # žádný posun out_time
+STARTUP_TIMEOUT_SEC  = 20     # první progress po spuštění (RTSP handshake)
+SEGMENT_TIMEOUT_SEC  = SEGMENT_DURATION * 2 + 2
+# BUFFER_MODE "pipe": segment přibude až s koncem GOP, limit je 2× naměřená
+# délka GOP (aspoň SEGMENT_TIMEOUT_SEC); dokud ji neznáme, platí tento
+GOP_TIMEOUT_SEC      = 30
+RESTART_DELAY_SEC    = 2      # první restart, pak exponenciálně
+RESTART_DELAY_MAX    = 60
+HEALTHY_RUNTIME_SEC  = 60     # po takto dlouhém zdravém běhu se backoff resetuje
+
+# Výstupní formát klipu:
+#   "ts"   – TS segmenty + M3U8 a k tomu zvlášť MP4 ke stažení
+#   "fmp4" – jediný fragmentovaný MP4, M3U8 ho adresuje přes EXT-X-BYTERANGE
+OUTPUT_FORMAT = "ts"
+
+# Pre-buffer kamery:
+#   "segments" – ffmpeg píše TS segmenty do RAM_BASE (tmpfs) a hlásí je segment listem
+#   "pipe"     – ffmpeg posílá MPEG-TS na stdout, pakety drží v paměti TsRing
+#                po GOP (od klíčového snímku); na disk se zapisuje až klip
+BUFFER_MODE = "segments"
+
 RAM_BASE    = Path("/dev/shm/nvr_buffer")
 OUTPUT_BASE = Path("./nvr")
+# Stav NVR na disku (evidence segmentů apod.) – mimo OUTPUT_BASE, nesynchronizuje se
+STATE_DIR   = Path("./nvr_state")
+# Segmenty klipu z TsRing před uložením (stejný disk jako OUTPUT_BASE → jen rename)
+STAGING_DIR = STATE_DIR / "staging"
+# Evidence se zapisuje jako žurnál změn; celý snímek se přepíše nejdřív po
+# tolika změnách (a nejdřív po tolika, kolik má evidence záznamů)
+LEDGER_COMPACT_OPS = 1000
+
+# Společný rozpočet RAM pro pre-buffery všech kamer (/dev/shm)
+RAM_BUDGET_BYTES  = 512 * 1024 * 1024
+RAM_SPILL_RATIO   = 0.8     # nad tímto podílem rozpočtu se nejdelší záznam předá na disk
+MAX_RECORDING_SEC = 120     # delší nahrávání se průběžně finalizuje na disk
+
+# Retence výstupu – výchozí limity, přepisuje sekce `retention` v conf.yaml
+# (globálně, u kamery nebo u jednotlivého streamu); None = bez limitu
+RETENTION_MAX_AGE_DAYS = None
+RETENTION_MAX_GB       = None
+
+# Záznam o dokončených synchronizacích (řádek "začátek konec" v epoch s),
+# zapisuje autosync.sh – podle něj se měří, kdy je klip venku na webu
+SYNC_LOG = STATE_DIR / "sync.log"
+LATENCY_WINDOW = 500    # počet posledních vzorků pro percentily
+
+# Finalizace (kopie, ffprobe, ffmpeg remux) běží mimo event loop
+FINALIZE_WORKERS = 4
+
+# Supervizor: 0 = všechny kamery v tomto procesu; N = kamery rozdělené do N
+# pracovních procesů (podle did); "did" = každá budka ve vlastním procesu.
+# Evidence klipů je pak po budkách ve STATE_DIR/dids/<did> (při prvním
+# spuštění ji budka převezme ze společné), platí tedy i po změně N.
+CAMERA_WORKERS = 0
+
+CONFIG_POLL_SEC  = 2       # jak často se kontroluje změna conf.yaml (reload i na SIGHUP)
+
+METRICS_FILE     = Path("/dev/shm/nvr_metrics.json")
+METRICS_INTERVAL = 10
 
 LOG_LEVEL = logging.INFO
 # ──────────────────────────────────────────────────────────────────────────────
@@ -42,7 +110,195 @@ logging.basicConfig(
 )
 log = logging.getLogger("nvr")
 
-_shutdown = threading.Event()
+_executor = ThreadPoolExecutor(max_workers=FINALIZE_WORKERS,
+                               thread_name_prefix="finalize")
+
+
+# ─── Metriky ──────────────────────────────────────────────────────────────────
+_metrics: dict[str, dict] = {}
+_metrics_lock = threading.Lock()
+
+
+def set_metric(section: str, values: dict):
+    with _metrics_lock:
+        _metrics[section] = values
+
+
+def write_metrics():
+    """Zapíše aktuální metriky jako JSON (atomicky přes rename)."""
+    with _metrics_lock:
+        snapshot = {"updated": int(time.time()), **_metrics}
+    tmp = METRICS_FILE.with_suffix(".tmp")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        tmp.replace(METRICS_FILE)
+    except OSError as e:
+        log.warning("Metriky nelze zapsat: %s", e)
+
+
+# ─── Rozpočet RAM ─────────────────────────────────────────────────────────────
+class RamBudget:
+    """
+    Procesově sdílená evidence obsazení /dev/shm po kamerách.
+    Recordery hlásí velikost svého bufferu, budget rozhoduje, kdo má
+    záznam předčasně předat na disk.
+    """
+
+    def __init__(self, limit_bytes: int, spill_ratio: float):
+        self.limit       = limit_bytes
+        self.spill_ratio = spill_ratio
+        self._usage: dict[str, int] = {}
+        self._spills = 0
+        self._lock   = threading.Lock()
+
+    def update(self, name: str, used_bytes: int):
+        with self._lock:
+            self._usage[name] = used_bytes
+
+    def release(self, name: str):
+        with self._lock:
+            self._usage.pop(name, None)
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self._usage.values())
+
+    def pressure(self) -> float:
+        return self.total() / self.limit if self.limit else 0.0
+
+    def should_spill(self, name: str) -> bool:
+        """True, pokud je rozpočet pod tlakem a `name` drží největší buffer."""
+        with self._lock:
+            total = sum(self._usage.values())
+            if not self.limit or total < self.limit * self.spill_ratio:
+                return False
+            biggest = max(self._usage, key=self._usage.get)
+            if biggest != name:
+                return False
+            self._spills += 1
+            return True
+
+    def report(self):
+        with self._lock:
+            usage = dict(self._usage)
+            spills = self._spills
+        total = sum(usage.values())
+        pressure = total / self.limit if self.limit else 0.0
+        set_metric("ram", {
+            "limit_bytes": self.limit,
+            "used_bytes": total,
+            "pressure": round(pressure, 3),
+            "spills": spills,
+            "per_camera": usage,
+        })
+        if pressure >= self.spill_ratio:
+            log.warning("RAM buffer pod tlakem: %.1f / %.1f MB (%.0f %%)",
+                        total / 1e6, self.limit / 1e6, pressure * 100)
+
+
+ram_budget = RamBudget(RAM_BUDGET_BYTES, RAM_SPILL_RATIO)
+
+
+# ─── Trasování latence ────────────────────────────────────────────────────────
+def detection_trace_id(did: str, device_ts, seq=None) -> str:
+    """trace_id detekce, která vlastní nemá. Stejně ho počítá pruletylog
+    (did + čas zařízení + seq), takže se trasy obou služeb spárují."""
+    if device_ts is None:
+        return uuid.uuid4().hex[:12]
+    key = f"{did}/{device_ts}/{'' if seq is None else seq}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+class Trace:
+    """
+    Časová razítka jedné detekce v jednom streamu:
+    mqtt_rx → trigger → finalize_start → written → synced.
+    """
+
+    STAGES = ("mqtt_rx", "trigger", "finalize_start", "written", "synced")
+
+    def __init__(self, trace_id: str, name: str, rx_time: float, device_ts=None):
+        self.trace_id  = trace_id
+        self.name      = name
+        self.device_ts = device_ts
+        self.stages: dict[str, float] = {"mqtt_rx": round(rx_time, 3)}
+
+    def mark(self, stage: str, when: float = None):
+        self.stages[stage] = round(when if when is not None else time.time(), 3)
+
+    def as_dict(self) -> dict:
+        return {"id": self.trace_id, "device_timestamp": self.device_ts,
+                "stages": dict(self.stages)}
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class LatencyTracker:
+    """Sbírá dokončené trasy a exportuje percentily mezi jednotlivými fázemi."""
+
+    def __init__(self, window: int):
+        self._lock    = threading.Lock()
+        self._samples: dict[str, deque] = {}
+        self._window  = window
+        self._pending: deque[Trace] = deque(maxlen=window)   # zapsané, čekají na sync
+        self._sync_offset = 0
+
+    def _add(self, key: str, value: float):
+        self._samples.setdefault(key, deque(maxlen=self._window)).append(value)
+
+    def _record(self, trace: Trace, last_only: bool = False):
+        stages = [s for s in Trace.STAGES if s in trace.stages]
+        pairs = list(zip(stages, stages[1:]))
+        for a, b in pairs[-1:] if last_only else pairs:
+            self._add(f"{a}->{b}", trace.stages[b] - trace.stages[a])
+        self._add(f"mqtt_rx->{stages[-1]}", trace.stages[stages[-1]] - trace.stages["mqtt_rx"])
+
+    def written(self, traces: list[Trace]):
+        with self._lock:
+            for trace in traces:
+                self._record(trace)
+                self._pending.append(trace)
+
+    def poll_sync_log(self):
+        """Klipy zapsané před začátkem synchronizace jsou venku jejím koncem."""
+        try:
+            with open(SYNC_LOG) as f:
+                f.seek(self._sync_offset)
+                lines = f.readlines()
+                self._sync_offset = f.tell()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            for line in lines:
+                try:
+                    start, end = (float(x) for x in line.split()[:2])
+                except ValueError:
+                    continue
+                while self._pending and self._pending[0].stages["written"] <= start:
+                    trace = self._pending.popleft()
+                    trace.mark("synced", end)
+                    self._record(trace, last_only=True)
+
+    def report(self):
+        with self._lock:
+            summary = {
+                key: {
+                    "count": len(vals),
+                    "p50": round(percentile(vals, 50), 3),
+                    "p90": round(percentile(vals, 90), 3),
+                    "p99": round(percentile(vals, 99), 3),
+                }
+                for key, vals in self._samples.items() if vals
+            }
+        set_metric("latency", summary)
+
+
+latency = LatencyTracker(LATENCY_WINDOW)
 
 
 # ─── Pomocné funkce ───────────────────────────────────────────────────────────
@@ -63,8 +319,9 @@ def get_segment_duration(seg: Path) -> float:
         return float(SEGMENT_DURATION)
 
 
-def write_m3u8(path: Path, segments: list[Path]):
-    durations = [get_segment_duration(s) for s in segments]
+def write_m3u8(path: Path, segments: list[Path], durations: list[float] = None):
+    if durations is None:
+        durations = [get_segment_duration(s) for s in segments]
     max_dur = max(durations) if durations else SEGMENT_DURATION
     total = sum(durations)
     log.info("M3U8 celkova delka: %.1fs, segmentu: %d", total, len(segments))
@@ -74,9 +331,9 @@ def write_m3u8(path: Path, segments: list[Path]):
         f.write(f"#EXT-X-TARGETDURATION:{int(max_dur) + 1}\n")
         f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
         for i, (seg, dur) in enumerate(zip(segments, durations)):
-            # seg je absolutní cesta v out_ts (did/stream_type/buffer_*.ts)
-            # z m3u8 ve out_m3u8 potřebujeme relativní cestu ts/did/stream_type/název
-            rel = Path("ts") / seg.parent.parent.name / seg.parent.name / seg.name
+            # seg je cesta v out_ts (ts/did/stream_type/RRRR/MM/DD/seg_*.ts),
+            # playlist na ni odkazuje relativně ke svému adresáři
+            rel = Path(os.path.relpath(seg, path.parent))
             if i > 0:
                 f.write("#EXT-X-DISCONTINUITY\n")
             f.write(f"#EXTINF:{dur:.3f},\n")
@@ -84,8 +341,9 @@ def write_m3u8(path: Path, segments: list[Path]):
         f.write("#EXT-X-ENDLIST\n")
 
 
-def write_meta(path: Path, did: str, stream_type: str, detection_ts: str):
-    """Uloží .meta JSON soubor vedle m3u8/mp4."""
+def write_meta(path: Path, did: str, stream_type: str, detection_ts: str,
+               traces: list[Trace] = None):
+    """Uloží .meta JSON soubor vedle m3u8/mp4 (volitelně s trasami detekcí)."""
     dt = datetime.strptime(detection_ts, "%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc)
     meta = {
         "did": did,
@@ -95,14 +353,18 @@ def write_meta(path: Path, did: str, stream_type: str, detection_ts: str):
         "date": dt.strftime("%Y-%m-%d"),
         "time": dt.strftime("%H:%M:%S"),
     }
+    if traces:
+        meta["traces"] = [t.as_dict() for t in traces]
     with open(path, "w") as f:
         json.dump(meta, f, indent=2)
     log.debug("Meta: %s", path)
+    return meta
 
 
-def create_thumbnail(segments: list[Path], thumb_path: Path):
+def create_thumbnail(segments: list[Path], thumb_path: Path, durations: list[float] = None):
     """Vygeneruje JPEG thumbnail z přibližné půlky záznamu."""
-    durations = [get_segment_duration(s) for s in segments]
+    if durations is None:
+        durations = [get_segment_duration(s) for s in segments]
     total = sum(durations)
     target = total / 2  # střed záznamu
 
@@ -136,7 +398,10 @@ def create_thumbnail(segments: list[Path], thumb_path: Path):
         log.error("Thumbnail chyba: %s", e)
 
 
-def create_mp4_concat(segments: list[Path], mp4_path: Path):
+def create_mp4_concat(segments: list[Path], mp4_path: Path, fragmented: bool = False) -> bool:
+    """Spojí segmenty do MP4. `fragmented` = fMP4 s moov na začátku
+    a fragmentem na každém keyframe (pro HLS s EXT-X-BYTERANGE)."""
+    movflags = "+frag_keyframe+empty_moov+default_base_moof" if fragmented else "+faststart"
     with tempfile.NamedTemporaryFile(mode="w", suffix=".txt",
                                      delete=False, dir="/tmp") as f:
         concat_list = Path(f.name)
@@ -150,7 +415,7 @@ def create_mp4_concat(segments: list[Path], mp4_path: Path):
         "-safe", "0",
         "-i", str(concat_list),
         "-c", "copy",
-        "-movflags", "+faststart",
+        "-movflags", movflags,
         str(mp4_path),
     ]
     try:
@@ -160,25 +425,734 @@ def create_mp4_concat(segments: list[Path], mp4_path: Path):
         else:
             log.info("MP4 ulozen: %s (%.1f MB)", mp4_path,
                      mp4_path.stat().st_size / 1e6)
+            return True
     except subprocess.TimeoutExpired:
         log.error("Timeout pri vytvareni MP4!")
     except Exception as e:
         log.error("Chyba: %s", e)
     finally:
         concat_list.unlink(missing_ok=True)
+    return False
+
+
+# ─── Fragmentovaný MP4 ────────────────────────────────────────────────────────
+def _iter_boxes(data: bytes, start: int = 0, end: int = None):
+    """Projde ISO BMFF boxy v data[start:end] → (typ, začátek, velikost, délka hlavičky)."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, typ = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            break
+        yield typ.decode("latin-1"), pos, size, header
+        pos += size
+
+
+def _child(data: bytes, box: tuple, typ: str):
+    _, pos, size, header = box
+    return next((b for b in _iter_boxes(data, pos + header, pos + size) if b[0] == typ), None)
+
+
+def fmp4_fragments(path: Path) -> tuple[int, list[tuple[int, int, float]]]:
+    """
+    Rozebere fMP4 z create_mp4_concat(fragmented=True).
+    Vrátí délku init sekce (ftyp+moov) a fragmenty (offset, délka, trvání v s);
+    trvání se počítá ze vzorků video stopy v trun/tfhd/trex.
+    """
+    data = path.read_bytes()
+    boxes = list(_iter_boxes(data))
+    moov = next(b for b in boxes if b[0] == "moov")
+    init_size = moov[1] + moov[2]
+
+    # Video stopa: track_ID, timescale a výchozí délka vzorku z trex
+    track_id, timescale, default_dur = None, None, 0
+    for trak in (b for b in _iter_boxes(data, moov[1] + moov[3], init_size) if b[0] == "trak"):
+        mdia = _child(data, trak, "mdia")
+        hdlr = _child(data, mdia, "hdlr")
+        if data[hdlr[1] + hdlr[3] + 8: hdlr[1] + hdlr[3] + 12] != b"vide":
+            continue
+        tkhd = _child(data, trak, "tkhd")
+        body = tkhd[1] + tkhd[3]
+        track_id = struct.unpack_from(">I", data, body + (20 if data[body] == 1 else 12))[0]
+        mdhd = _child(data, mdia, "mdhd")
+        body = mdhd[1] + mdhd[3]
+        timescale = struct.unpack_from(">I", data, body + (20 if data[body] == 1 else 12))[0]
+        break
+    if track_id is None:
+        raise ValueError(f"{path}: chybi video stopa")
+    mvex = _child(data, moov, "mvex")
+    if mvex:
+        for trex in (b for b in _iter_boxes(data, mvex[1] + mvex[3], mvex[1] + mvex[2])
+                     if b[0] == "trex"):
+            tid, _, dur = struct.unpack_from(">III", data, trex[1] + trex[3] + 4)
+            if tid == track_id:
+                default_dur = dur
+
+    fragments = []
+    for i, box in enumerate(boxes):
+        if box[0] != "moof":
+            continue
+        mdat = boxes[i + 1] if i + 1 < len(boxes) and boxes[i + 1][0] == "mdat" else None
+        length = box[2] + (mdat[2] if mdat else 0)
+        ticks = 0
+        for traf in (b for b in _iter_boxes(data, box[1] + box[3], box[1] + box[2])
+                     if b[0] == "traf"):
+            tfhd = _child(data, traf, "tfhd")
+            body = tfhd[1] + tfhd[3]
+            flags = int.from_bytes(data[body + 1: body + 4], "big")
+            if struct.unpack_from(">I", data, body + 4)[0] != track_id:
+                continue
+            off = body + 8 + (8 if flags & 0x01 else 0) + (4 if flags & 0x02 else 0)
+            sample_dur = struct.unpack_from(">I", data, off)[0] if flags & 0x08 else default_dur
+            for trun in (b for b in _iter_boxes(data, traf[1] + traf[3], traf[1] + traf[2])
+                         if b[0] == "trun"):
+                body = trun[1] + trun[3]
+                tflags = int.from_bytes(data[body + 1: body + 4], "big")
+                count = struct.unpack_from(">I", data, body + 4)[0]
+                off = body + 8 + (4 if tflags & 0x01 else 0) + (4 if tflags & 0x04 else 0)
+                if not tflags & 0x100:
+                    ticks += count * sample_dur
+                    continue
+                stride = 4 * bin(tflags & 0xF00).count("1")
+                for n in range(count):
+                    ticks += struct.unpack_from(">I", data, off + n * stride)[0]
+        fragments.append((box[1], length, ticks / timescale))
+    return init_size, fragments
+
+
+def write_m3u8_fmp4(path: Path, mp4_path: Path):
+    """M3U8 nad jediným fMP4: init přes EXT-X-MAP, fragmenty přes EXT-X-BYTERANGE."""
+    init_size, fragments = fmp4_fragments(mp4_path)
+    rel = Path(os.path.relpath(mp4_path, path.parent))
+    max_dur = max((d for _, _, d in fragments), default=SEGMENT_DURATION)
+    log.info("M3U8 (fMP4) celkova delka: %.1fs, fragmentu: %d",
+             sum(d for _, _, d in fragments), len(fragments))
+    with open(path, "w") as f:
+        f.write("#EXTM3U\n")
+        f.write("#EXT-X-VERSION:7\n")
+        f.write(f"#EXT-X-TARGETDURATION:{int(max_dur) + 1}\n")
+        f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
+        f.write(f'#EXT-X-MAP:URI="{rel}",BYTERANGE="{init_size}@0"\n')
+        for offset, length, dur in fragments:
+            f.write(f"#EXTINF:{dur:.3f},\n")
+            f.write(f"#EXT-X-BYTERANGE:{length}@{offset}\n")
+            f.write(f"{rel}\n")
+        f.write("#EXT-X-ENDLIST\n")
+
+
+# ─── MPEG-TS ring buffer ──────────────────────────────────────────────────────
+TS_PACKET = 188
+TS_SYNC   = 0x47
+PTS_CLOCK = 90000
+PTS_WRAP  = 1 << 33
+# stream_type v PMT: MPEG-1/2 video, MPEG-4 part 2, H.264, HEVC
+VIDEO_STREAM_TYPES = {0x01, 0x02, 0x10, 0x1B, 0x24}
+
+
+def _ts_payload(data, off: int) -> int | None:
+    """Offset payloadu TS paketu na `off` (za adaptation field), None bez payloadu."""
+    afc = (data[off + 3] >> 4) & 3
+    if not afc & 1:
+        return None
+    pos = off + 4
+    if afc & 2:
+        pos += 1 + data[off + 4]
+    return pos if pos < off + TS_PACKET else None
+
+
+def _psi_section(data, off: int, table_id: int) -> tuple[int, int] | None:
+    """(začátek, konec bez CRC) PSI sekce v paketu se začátkem jednotky."""
+    pos = _ts_payload(data, off)
+    if pos is None:
+        return None
+    start = pos + 1 + data[pos]     # pointer_field
+    if start + 3 > off + TS_PACKET or data[start] != table_id:
+        return None
+    length = ((data[start + 1] & 0x0F) << 8) | data[start + 2]
+    return start, min(start + 3 + length - 4, off + TS_PACKET)
+
+
+def _pes_pts(data, pos: int) -> int | None:
+    """PTS z hlavičky PES začínající na `pos`."""
+    if data[pos:pos + 3] != b"\x00\x00\x01" or not data[pos + 7] & 0x80:
+        return None
+    p = data[pos + 9:pos + 14]
+    if len(p) < 5:
+        return None
+    return (((p[0] >> 1) & 0x07) << 30 | p[1] << 22 | (p[2] >> 1) << 15
+            | p[3] << 7 | p[4] >> 1)
+
+
+class Gop:
+    """Pakety od jednoho klíčového snímku videa po další."""
+
+    __slots__ = ("pts", "wall", "data", "duration")
+
+    def __init__(self, pts: int, wall: float):
+        self.pts      = pts
+        self.wall     = wall          # čas příchodu klíčového snímku (epoch s)
+        self.data     = bytearray()
+        self.duration = 0.0           # známá až se začátkem další GOP
+
+
+class TsRing:
+    """
+    Pre-buffer v paměti nad MPEG-TS ze stdout ffmpeg (BUFFER_MODE = "pipe").
+    Pakety se řadí do GOP podle random_access_indicator na video PID;
+    délka GOP je rozdíl PTS sousedních klíčových snímků. Poslední PAT/PMT
+    se drží zvlášť (s nulovým continuity counterem, aby se neměnily s každým
+    zopakováním) a předřadí se každému zapsanému segmentu.
+    """
+
+    def __init__(self):
+        self.gops: deque[Gop] = deque()   # uzavřené GOP, od nejstarší
+        self.current: Gop | None = None   # právě přicházející GOP
+        self.bytes   = 0                  # součet uzavřených GOP
+        self.seconds = 0.0
+        self._rest   = b""                # neúplný paket z minulého čtení
+        self._pat = self._pmt = b""
+        self._pmt_pid   = None
+        self._video_pid = None
+
+    def headers(self) -> bytes:
+        return self._pat + self._pmt
+
+    def _close_current(self, duration: float) -> Gop | None:
+        gop, self.current = self.current, None
+        if gop is None:
+            return None
+        gop.duration = duration
+        self.gops.append(gop)
+        self.bytes += len(gop.data)
+        self.seconds += duration
+        return gop
+
+    def feed(self, chunk: bytes) -> list[Gop]:
+        """Zpracuje blok ze stdout ffmpeg; vrátí GOP, které tím skončily."""
+        data = self._rest + chunk
+        closed: list[Gop] = []
+        start = off = 0     # start = první paket, který ještě není v žádné GOP
+        while off + TS_PACKET <= len(data):
+            if data[off] != TS_SYNC:
+                # Ztráta synchronizace – rozpracovaná GOP je poškozená
+                nxt = data.find(TS_SYNC, off + 1)
+                off = start = nxt if nxt >= 0 else len(data)
+                self.current = None
+                continue
+            b1 = data[off + 1]
+            if b1 & 0x40:   # payload_unit_start_indicator
+                pid = ((b1 & 0x1F) << 8) | data[off + 2]
+                if pid == self._video_pid:
+                    pts = self._keyframe_pts(data, off)
+                    if pts is not None:
+                        if self.current is not None:
+                            self.current.data += data[start:off]
+                            gop = self._close_current(
+                                ((pts - self.current.pts) % PTS_WRAP) / PTS_CLOCK)
+                            closed.append(gop)
+                        start = off
+                        self.current = Gop(pts, time.time())
+                elif pid == 0:
+                    self._parse_pat(data, off)
+                elif pid == self._pmt_pid:
+                    self._parse_pmt(data, off)
+            off += TS_PACKET
+        if self.current is not None:
+            self.current.data += data[start:off]
+        self._rest = data[off:]
+        return closed
+
+    @staticmethod
+    def _keyframe_pts(data, off: int) -> int | None:
+        afc = (data[off + 3] >> 4) & 3
+        # random_access_indicator v adaptation field
+        if not (afc & 2 and data[off + 4] > 0 and data[off + 5] & 0x40):
+            return None
+        pos = _ts_payload(data, off)
+        return None if pos is None else _pes_pts(data, pos)
+
+    @staticmethod
+    def _canonical(data, off: int) -> bytes:
+        """Kopie PSI paketu s continuity counterem 0 – segmenty překrývajících
+        se klipů pak mají shodnou hlavičku a SegmentStore je uloží jednou."""
+        packet = bytearray(data[off:off + TS_PACKET])
+        packet[3] &= 0xF0
+        return bytes(packet)
+
+    def _parse_pat(self, data, off: int):
+        section = _psi_section(data, off, 0x00)
+        if section is None:
+            return
+        start, end = section
+        for pos in range(start + 8, end - 3, 4):
+            program = (data[pos] << 8) | data[pos + 1]
+            if program:     # program 0 = síťová informace
+                self._pmt_pid = ((data[pos + 2] & 0x1F) << 8) | data[pos + 3]
+                self._pat = self._canonical(data, off)
+                return
+
+    def _parse_pmt(self, data, off: int):
+        section = _psi_section(data, off, 0x02)
+        if section is None:
+            return
+        start, end = section
+        pos = start + 12 + (((data[start + 10] & 0x0F) << 8) | data[start + 11])
+        while pos + 5 <= end:
+            es_pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+            if data[pos] in VIDEO_STREAM_TYPES:
+                self._video_pid = es_pid
+                self._pmt = self._canonical(data, off)
+                return
+            pos += 5 + (((data[pos + 3] & 0x0F) << 8) | data[pos + 4])
+
+    def restart(self) -> Gop | None:
+        """Nový proces ffmpeg: uzavře rozpracovanou GOP podle hodin (PTS začne znovu)."""
+        self._rest = b""
+        if self.current is None:
+            return None
+        return self._close_current(round(time.time() - self.current.wall, 3))
+
+    def trim(self, keep_sec: float):
+        """Zahodí nejstarší GOP, dokud zbytek pokrývá aspoň `keep_sec`."""
+        while self.gops and self.seconds - self.gops[0].duration >= keep_sec:
+            gop = self.gops.popleft()
+            self.bytes -= len(gop.data)
+            self.seconds -= gop.duration
+
+    def passed(self, cutoff: float) -> bool:
+        """Přišel už klíčový snímek po `cutoff`, tj. GOP s koncem klipu je celá?"""
+        return self.current is not None and self.current.wall >= cutoff
+
+    def take(self, cutoff: float) -> list[Gop]:
+        """Vyjme uzavřené GOP začínající před `cutoff`."""
+        taken = []
+        while self.gops and self.gops[0].wall < cutoff:
+            gop = self.gops.popleft()
+            self.bytes -= len(gop.data)
+            self.seconds -= gop.duration
+            taken.append(gop)
+        return taken
+
+    def restore(self, gops: list[Gop]):
+        """Vrátí GOP na začátek bufferu (konec klipu jako pre-buffer dalšího)."""
+        for gop in reversed(gops):
+            self.gops.appendleft(gop)
+            self.bytes += len(gop.data)
+            self.seconds += gop.duration
+
+    def clear(self):
+        self.gops.clear()
+        self.current = None
+        self.bytes, self.seconds = 0, 0.0
+
+
+def group_gops(gops: list[Gop]) -> list[list[Gop]]:
+    """
+    Seskupí GOP do segmentů podle okna SEGMENT_DURATION na ose PTS.
+    Překrývající se klipy tak dostanou shodné segmenty a SegmentStore
+    je uloží jen jednou.
+    """
+    span = SEGMENT_DURATION * PTS_CLOCK
+    groups: list[list[Gop]] = []
+    last = None
+    for gop in gops:
+        key = gop.pts // span
+        if key != last:
+            groups.append([])
+            last = key
+        groups[-1].append(gop)
+    return groups
+
+
+# ─── Evidence na disku ────────────────────────────────────────────────────────
+class Ledger:
+    """
+    Evidence na disku jako snímek (JSON) a žurnál změn vedle něj (řádek JSON
+    na změnu). Změna se jen připíše na konec žurnálu; snímek se přepíše až
+    po LEDGER_COMPACT_OPS změnách, a nejdřív po tolika, kolik má evidence
+    záznamů – přepis tak stojí amortizovaně O(1) na změnu. Změny nesou
+    pořadové číslo, pád mezi zápisem snímku a zkrácením žurnálu nic nezdvojí.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.journal_path = path.with_suffix(".journal")
+        self._seq = 0           # pořadí poslední změny
+        self._pending = 0       # změn v žurnálu od posledního snímku
+        self._journal = None
+
+    def exists(self) -> bool:
+        return self.path.exists() or self.journal_path.exists()
+
+    def load(self) -> dict:
+        """Snímek evidence; změny z žurnálu se na něj přehrají přes replay()."""
+        if not self.path.exists():
+            return {}
+        with open(self.path) as f:
+            data = json.load(f)
+        self._seq = data.pop("seq", 0)
+        return data
+
+    def replay(self, apply):
+        """Předá `apply` změny z žurnálu novější než snímek."""
+        if not self.journal_path.exists():
+            return
+        good = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError
+                    op = json.loads(line)
+                except ValueError:
+                    break       # neúplný poslední řádek po pádu
+                good += len(line)
+                if op["seq"] <= self._seq:
+                    continue
+                apply(op)
+                self._seq = op["seq"]
+                self._pending += 1
+        if good < self.journal_path.stat().st_size:
+            os.truncate(self.journal_path, good)
+
+    def append(self, op: dict, size: int, snapshot):
+        """Zapíše změnu; `snapshot()` vrací celou evidenci pro případný přepis."""
+        self._seq += 1
+        op["seq"] = self._seq
+        if self._journal is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._journal = open(self.journal_path, "a")
+        self._journal.write(json.dumps(op) + "\n")
+        self._journal.flush()
+        self._pending += 1
+        if self._pending >= max(LEDGER_COMPACT_OPS, size):
+            self.compact(snapshot())
+
+    def compact(self, data: dict):
+        """Přepíše snímek a vyprázdní žurnál."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({**data, "seq": self._seq}, f)
+        tmp.replace(self.path)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        open(self.journal_path, "w").close()
+        self._pending = 0
+
+
+# ─── Úložiště segmentů ────────────────────────────────────────────────────────
+class SegmentStore:
+    """
+    TS segmenty na disku uložené jen jednou pod jménem podle obsahu (sha1).
+    Překrývající se klipy odkazují na stejné soubory; evidence počítá
+    reference klipů a segment se smaže až s posledním klipem, který ho používá.
+    """
+
+    def __init__(self, ledger_path: Path):
+        self._ledger = Ledger(ledger_path)
+        self._lock = threading.Lock()
+        data = self._ledger.load()
+        self._segments: dict[str, dict] = data.get("segments", {})   # relativní cesta → {"refs", "size"}
+        self._clips: dict[str, list[str]] = data.get("clips", {})     # clip_id → [relativní cesty]
+        self._ledger.replay(self._apply)
+
+    def snapshot(self, clip_ids: set[str] = None) -> dict:
+        """Evidence (jen klipy `clip_ids` a jejich segmenty, je-li zadáno)."""
+        with self._lock:
+            clips = {cid: rels for cid, rels in self._clips.items()
+                     if clip_ids is None or cid in clip_ids}
+            rels = {rel for clip_rels in clips.values() for rel in clip_rels}
+            segments = {rel: dict(e) for rel, e in self._segments.items()
+                        if clip_ids is None or rel in rels}
+        return {"segments": segments, "clips": clips}
+
+    def _snapshot(self) -> dict:
+        return {"segments": self._segments, "clips": self._clips}
+
+    def _apply(self, op: dict) -> tuple[int, list[str]]:
+        """Provede změnu evidence; vrátí (přibylé bajty, segmenty bez referencí)."""
+        added, orphaned = 0, []
+        if op["op"] == "add":
+            self._clips[op["clip"]] = [rel for rel, _ in op["segments"]]
+            for rel, size in op["segments"]:
+                entry = self._segments.get(rel)
+                if entry is None:
+                    entry = self._segments[rel] = {"refs": 0, "size": size}
+                    added += size
+                entry["refs"] += 1
+        elif op["op"] == "release":
+            for rel in self._clips.pop(op["clip"], []):
+                entry = self._segments.get(rel)
+                if entry is None:
+                    continue
+                entry["refs"] -= 1
+                if entry["refs"] <= 0:
+                    del self._segments[rel]
+                    orphaned.append(rel)
+        return added, orphaned
+
+    def put(self, seg: Path, out_dir: Path, move: bool = False) -> Path:
+        """Uloží segment do `out_dir`, pokud tam stejný obsah ještě není.
+        `move` = zdroj je dočasný soubor na disku, stačí ho přejmenovat."""
+        h = hashlib.sha1()
+        with open(seg, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        dest = out_dir / f"seg_{h.hexdigest()}.ts"
+        if dest.exists():
+            return dest
+        if move:
+            try:
+                seg.replace(dest)
+                return dest
+            except OSError:
+                pass    # jiný souborový systém – kopie
+        # Kopie přes rename, aby autosync viděl jen hotový soubor
+        tmp = dest.with_suffix(".part")
+        shutil.copy2(seg, tmp)
+        tmp.replace(dest)
+        return dest
+
+    def add_clip(self, clip_id: str, segments: list[Path]) -> int:
+        """Zaeviduje klip; vrátí bajty segmentů, které na disku přibyly."""
+        op = {"op": "add", "clip": clip_id,
+              "segments": [[str(s.relative_to(OUTPUT_BASE)), s.stat().st_size]
+                           for s in segments]}
+        with self._lock:
+            added, _ = self._apply(op)
+            self._ledger.append(op, len(self._clips), self._snapshot)
+        return added
+
+    def release_clip(self, clip_id: str) -> int:
+        """Odebere klip; smaže segmenty bez referencí a vrátí uvolněné bajty."""
+        freed = 0
+        with self._lock:
+            sizes = {rel: self._segments[rel]["size"]
+                     for rel in self._clips.get(clip_id, []) if rel in self._segments}
+            op = {"op": "release", "clip": clip_id}
+            _, orphaned = self._apply(op)
+            self._ledger.append(op, len(self._clips), self._snapshot)
+            for rel in orphaned:
+                (OUTPUT_BASE / rel).unlink(missing_ok=True)
+                freed += sizes[rel]
+        return freed
+
+
+segment_store = SegmentStore(STATE_DIR / "segments.json")
+
+
+# ─── Retence ──────────────────────────────────────────────────────────────────
+def date_shard(detection_ts: str) -> Path:
+    """RRRR/MM/DD podle času detekce – adresáře výstupu se nezaplní."""
+    return Path(detection_ts[0:4]) / detection_ts[4:6] / detection_ts[6:8]
+
+
+class RetentionManager:
+    """
+    Limity stáří a velikosti výstupu pro každý did/stream_type.
+    Obsazení se vede průběžně v evidenci (přičítá se při finalizaci,
+    odečítá při mazání), kontrola limitu tak nikdy neprochází strom.
+    Při překročení velikosti se nejdřív mažou redundantní varianty
+    (MP4 ke klipu, který má i HLS), teprve potom celé nejstarší klipy.
+    """
+
+    PRIMARY = "hls"
+
+    def __init__(self, ledger_path: Path, store: SegmentStore):
+        self._ledger = Ledger(ledger_path)
+        self.store = store          # úložiště segmentů klipů této evidence
+        self._lock = threading.Lock()
+        self._policies: dict[str, dict] = {}
+        data = self._ledger.load()
+        # clip_id → {"key", "timestamp", "variants": {název: {"files", "size"}}, "segment_bytes"}
+        self._clips: dict[str, dict] = data.get("clips", {})
+        self._usage: dict[str, int] = data.get("usage", {})
+        # did/stream_type → [clip_id] od nejstaršího
+        self._by_key: dict[str, list[str]] = {}
+        for clip_id, entry in self._clips.items():
+            self._by_key.setdefault(entry["key"], []).append(clip_id)
+        self._ledger.replay(self._apply)
+
+    def snapshot(self, did: str = None) -> dict:
+        """Evidence (jen streamy budky `did`, je-li zadáno)."""
+        def wanted(key: str) -> bool:
+            return did is None or key.rsplit("/", 1)[0] == did
+        with self._lock:
+            return {
+                "clips": {cid: e for cid, e in self._clips.items() if wanted(e["key"])},
+                "usage": {k: v for k, v in self._usage.items() if wanted(k)},
+            }
+
+    def _snapshot(self) -> dict:
+        return {"clips": self._clips, "usage": self._usage}
+
+    def _apply(self, op: dict):
+        """Provede změnu evidence (i při přehrání žurnálu)."""
+        clip_id = op["clip"]
+        if op["op"] == "add":
+            entry = op["entry"]
+            self._clips[clip_id] = entry
+            self._by_key.setdefault(entry["key"], []).append(clip_id)
+            self._usage[entry["key"]] = self._usage.get(entry["key"], 0) + op["size"]
+        elif op["op"] == "drop_variant":
+            entry = self._clips[clip_id]
+            self._usage[entry["key"]] -= entry["variants"].pop(op["variant"])["size"]
+        elif op["op"] == "drop_clip":
+            entry = self._clips.pop(clip_id)
+            self._by_key[entry["key"]].remove(clip_id)
+            self._usage[entry["key"]] -= op["freed"]
+
+    def _change(self, op: dict):
+        self._apply(op)
+        self._ledger.append(op, len(self._clips), self._snapshot)
+
+    def set_policy(self, did: str, stream_type: str, policy: dict):
+        max_age = policy.get("max_age_days", RETENTION_MAX_AGE_DAYS)
+        max_gb  = policy.get("max_gb", RETENTION_MAX_GB)
+        self._policies[f"{did}/{stream_type}"] = {
+            "max_age": max_age * 86400 if max_age else None,
+            "max_bytes": int(max_gb * 1e9) if max_gb else None,
+        }
+
+    def add_clip(self, clip_id: str, did: str, stream_type: str, timestamp: int,
+                 variants: dict[str, list[Path]], segment_bytes: int):
+        entry = {"key": f"{did}/{stream_type}", "timestamp": timestamp, "variants": {},
+                 "segment_bytes": segment_bytes}
+        total = segment_bytes
+        for name, files in variants.items():
+            files = [f for f in files if f.exists()]
+            size = sum(f.stat().st_size for f in files)
+            entry["variants"][name] = {
+                "files": [str(f.relative_to(OUTPUT_BASE)) for f in files],
+                "size": size,
+            }
+            total += size
+        with self._lock:
+            self._change({"op": "add", "clip": clip_id, "entry": entry, "size": total})
+
+    def _drop_variant(self, clip_id: str, name: str):
+        for rel in self._clips[clip_id]["variants"][name]["files"]:
+            (OUTPUT_BASE / rel).unlink(missing_ok=True)
+        self._change({"op": "drop_variant", "clip": clip_id, "variant": name})
+        log.info("Retence: smazana varianta %s klipu %s", name, clip_id)
+
+    def _drop_clip(self, clip_id: str):
+        for name in list(self._clips[clip_id]["variants"]):
+            self._drop_variant(clip_id, name)
+        # Sdílené segmenty se uvolní až s posledním klipem; evidence odečte,
+        # co skutečně zmizelo z disku
+        freed = self.store.release_clip(clip_id)
+        self._change({"op": "drop_clip", "clip": clip_id, "freed": freed})
+        log.info("Retence: smazan klip %s", clip_id)
+
+    def enforce(self):
+        """Aplikuje limity; klipy jsou v evidenci od nejstaršího. Nejnovější
+        klip se kvůli velikosti nemaže, i kdyby sám limit přesahoval."""
+        now = time.time()
+        with self._lock:
+            for key, policy in self._policies.items():
+                clips = self._by_key.get(key, [])
+                if policy["max_age"]:
+                    while clips and self._clips[clips[0]]["timestamp"] < now - policy["max_age"]:
+                        self._drop_clip(clips[0])
+                max_bytes = policy["max_bytes"]
+                if not max_bytes or self._usage.get(key, 0) <= max_bytes:
+                    continue
+                for cid in clips[:-1]:
+                    if self._usage[key] <= max_bytes:
+                        break
+                    for name in list(self._clips[cid]["variants"]):
+                        if name != self.PRIMARY:
+                            self._drop_variant(cid, name)
+                while len(clips) > 1 and self._usage[key] > max_bytes:
+                    self._drop_clip(clips[0])
+
+    def usage(self) -> tuple[int, dict[str, int]]:
+        """(počet klipů, obsazení po streamech)"""
+        with self._lock:
+            return len(self._clips), dict(self._usage)
+
+
+retention = RetentionManager(STATE_DIR / "usage.json", segment_store)
+
+# Pracovní procesy vedou evidenci po budkách (STATE_DIR/dids/<did>): všechny
+# streamy budky jsou vždy v jednom workeru, takže ji najde každé rozdělení
+_did_ledgers: dict[str, RetentionManager] = {}
+
+
+def retention_for(did: str) -> RetentionManager:
+    """Evidence (retence a segmenty), do které patří klipy budky."""
+    if not CAMERA_WORKERS:
+        return retention
+    manager = _did_ledgers.get(did)
+    if manager is None:
+        state = STATE_DIR / "dids" / did
+        seed_did_ledgers(state, did)
+        manager = _did_ledgers[did] = RetentionManager(
+            state / "usage.json", SegmentStore(state / "segments.json"))
+    return manager
+
+
+def seed_did_ledgers(state: Path, did: str):
+    """Budka poprvé ve workeru převezme ze společné evidence (režim bez
+    supervizoru) své klipy a segmenty, aby na ně dál platila retence."""
+    if Ledger(state / "usage.json").exists():
+        return
+    usage = retention.snapshot(did)
+    clips = set(usage["clips"])
+    # usage.json až jako poslední – podle ní se pozná, že je evidence převzatá
+    Ledger(state / "segments.json").compact(segment_store.snapshot(clips))
+    Ledger(state / "usage.json").compact(usage)
+    if clips:
+        log.info("[%s] Prevzato %d klipu ze spolecne evidence", did, len(clips))
+
+
+def all_ledgers() -> list[RetentionManager]:
+    return list(_did_ledgers.values()) if CAMERA_WORKERS else [retention]
+
+
+def enforce_retention():
+    for manager in all_ledgers():
+        manager.enforce()
+
+
+def report_storage():
+    clips, used = 0, {}
+    for manager in all_ledgers():
+        count, usage = manager.usage()
+        clips += count
+        used.update(usage)
+    set_metric("storage", {"clips": clips, "used_bytes": used})
 
 
 # ─── Třída jedné kamery ───────────────────────────────────────────────────────
 class CameraRecorder:
     """
     Jeden CameraRecorder = jeden RTSP stream jednoho typu (indoor/outdoor).
-    Má vlastní RAM buffer, stavový automat a finalizační thread.
+    Má vlastní RAM buffer a stavový automat řízený časovači event loopu.
+    Hotové segmenty hlásí ffmpeg přes segment list na stdout, takže se
+    adresář v RAM nemusí pollovat; v režimu "pipe" drží buffer TsRing
+    přímo v paměti procesu. Finalizace běží v executoru.
     """
 
     IDLE       = "IDLE"
     RECORDING  = "RECORDING"
     FINALIZING = "FINALIZING"
 
+    # Zdraví ffmpeg
+    STARTING = "STARTING"
+    HEALTHY  = "HEALTHY"
+    STALLED  = "STALLED"
+    BACKOFF  = "BACKOFF"
+
     def __init__(self, did: str, stream_type: str, rtsp_url: str, extra_args: list = None):
         self.did         = did
         self.stream_type = stream_type
@@ -191,117 +1165,283 @@ class CameraRecorder:
         self.out_m3u8    = OUTPUT_BASE / "m3u8"
         self.out_mp4     = OUTPUT_BASE
 
-        self._lock           = threading.Lock()
         self._state          = self.IDLE
         self._last_det_time  = None
-        self._finalize_event = threading.Event()
-
+        self._rec_start      = None
+        self._spilling       = False
+        self._finalize_running = False
+
+        # Trasy detekcí, které spadají do právě nahrávaného klipu
+        self._traces: list[Trace] = []
+
+        # Hotové segmenty v RAM: (cesta, délka v s, velikost v B), od nejstaršího
+        self._segments: list[tuple[Path, float, int]] = []
+        # BUFFER_MODE "pipe": GOP v paměti místo segmentů
+        self._ring = TsRing()
+        self.staging = STAGING_DIR / did / stream_type
+        self.retention = retention_for(did)
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._post_timer: asyncio.TimerHandle | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._proc: asyncio.subprocess.Process | None = None
+
+        self._health        = self.STARTING
+        self._restarts      = 0
+        self._stalls        = 0
+        self._proc_start    = None
+        self._last_progress = None    # monotonic čas posledního posunu out_time
+        self._last_out_time = None
+        self._last_segment  = None    # monotonic čas posledního segmentu
+        self._last_gop_sec  = None    # délka poslední GOP v režimu "pipe"
+        self._reconfigured  = False   # ffmpeg ukončen kvůli změně konfigurace
+
+        self._idle = asyncio.Event()  # nastaveno ve stavu IDLE (pro odebrání kamery)
+        self._idle.set()
+
+        if BUFFER_MODE == "pipe":
+            self.staging.mkdir(parents=True, exist_ok=True)
+            for old in self.staging.glob("*.ts"):
+                old.unlink(missing_ok=True)
+            return
         self.ram_dir.mkdir(parents=True, exist_ok=True)
-
-        self._pre_buffer_segments = max(1, round(PRE_BUFFER_SEC / SEGMENT_DURATION))
+        # Zbytky po předchozím běhu nejsou v segment listu, jen by zabíraly RAM
+        for old in sorted_segments(self.ram_dir):
+            old.unlink(missing_ok=True)
 
     # ── Stavový automat ───────────────────────────────────────────────────────
-    def trigger_detection(self):
+    def trigger_detection(self, trace_id: str = None, rx_time: float = None, device_ts=None):
+        """Volá se z event loopu (MQTT thread předává přes call_soon_threadsafe)."""
         now = time.time()
-        with self._lock:
-            self._last_det_time = now
-            if self._state == self.IDLE:
-                self._state = self.RECORDING
-                log.info("[%s] ▶ Nahravani zahajeno (%s UTC)",
-                         self.name,
-                         datetime.fromtimestamp(now, tz=timezone.utc).strftime("%H:%M:%S"))
-            elif self._state == self.RECORDING:
-                log.info("[%s] ↺ Post-window prodlouzen (%s UTC)",
-                         self.name,
-                         datetime.fromtimestamp(now, tz=timezone.utc).strftime("%H:%M:%S"))
-            elif self._state == self.FINALIZING:
-                self._state = self.RECORDING
-                log.info("[%s] ↺ Nova detekce behem finalizace", self.name)
-
-    def _try_end_recording(self) -> bool:
-        with self._lock:
-            if self._state != self.RECORDING:
-                return False
-            if self._last_det_time is None:
-                return False
-            if (time.time() - self._last_det_time) >= POST_DETECTION_SEC:
-                self._state = self.FINALIZING
-                log.info("[%s] Post-window vyprselo, finalizuji...", self.name)
-                return True
-        return False
+        trace = Trace(trace_id or uuid.uuid4().hex[:12], self.name,
+                      rx_time if rx_time is not None else now, device_ts)
+        trace.mark("trigger", now)
+        self._traces.append(trace)
+        self._last_det_time = now
+        self._arm_post_timer(POST_DETECTION_SEC)
+        if self._state == self.IDLE:
+            self._state = self.RECORDING
+            self._rec_start = now
+            self._idle.clear()
+            log.info("[%s] ▶ Nahravani zahajeno (%s UTC)",
+                     self.name,
+                     datetime.fromtimestamp(now, tz=timezone.utc).strftime("%H:%M:%S"))
+        elif self._state == self.RECORDING:
+            log.info("[%s] ↺ Post-window prodlouzen (%s UTC)",
+                     self.name,
+                     datetime.fromtimestamp(now, tz=timezone.utc).strftime("%H:%M:%S"))
+        elif self._state == self.FINALIZING:
+            if self._spilling or self._finalize_running:
+                # Rozběhnutá finalizace se nepřerušuje, po ní se nahrává dál
+                log.info("[%s] ↺ Nova detekce behem zapisu na disk", self.name)
+                return
+            self._state = self.RECORDING
+            log.info("[%s] ↺ Nova detekce behem finalizace", self.name)
+
+    def _arm_post_timer(self, delay: float):
+        if self._post_timer:
+            self._post_timer.cancel()
+        self._post_timer = self._loop.call_later(delay, self._on_post_window_expired)
+
+    def _on_post_window_expired(self):
+        self._post_timer = None
+        if self._state == self.RECORDING:
+            log.info("[%s] Post-window vyprselo, finalizuji...", self.name)
+            self._begin_finalizing(spill=False)
+
+    def _check_recording_limits(self):
+        if self._state != self.RECORDING:
+            return
+        if (time.time() - self._rec_start) >= MAX_RECORDING_SEC:
+            log.info("[%s] Nahravani delsi nez %ds, predavam na disk...",
+                     self.name, MAX_RECORDING_SEC)
+            self._begin_finalizing(spill=True)
+        elif ram_budget.should_spill(self.name):
+            log.warning("[%s] Rozpocet RAM vycerpan, predavam na disk...", self.name)
+            self._begin_finalizing(spill=True)
+
+    def _begin_finalizing(self, spill: bool):
+        self._state = self.FINALIZING
+        self._spilling = spill
+        self._spawn(self._finalize_after_delay(), f"finalize-{self.name}")
 
     def _end_finalizing(self):
-        with self._lock:
+        self._spilling = False
+        self._finalize_running = False
+        remaining = self._last_det_time + POST_DETECTION_SEC - time.time()
+        if remaining > 0:
+            # Detekce přišla během zápisu – pokračuj novým záznamem
+            self._state = self.RECORDING
+            self._rec_start = time.time()
+            self._arm_post_timer(remaining)
+        else:
             self._state = self.IDLE
-        log.info("[%s] IDLE", self.name)
+            self._prune_buffer()
+            self._idle.set()
+        log.info("[%s] %s", self.name, self._state)
 
-    def _get_state(self):
-        with self._lock:
-            return self._state, self._last_det_time
+    def get_state(self):
+        return self._state, self._last_det_time
 
     # ── Buffer ────────────────────────────────────────────────────────────────
+    def _report_usage(self):
+        if BUFFER_MODE == "pipe":
+            ram_budget.update(self.name, self._ring.bytes)
+            return
+        ram_budget.update(self.name, sum(size for _, _, size in self._segments))
+
+    def _buffer_sec(self) -> float:
+        if BUFFER_MODE == "pipe":
+            return self._ring.seconds
+        return sum(dur for _, dur, _ in self._segments)
+
     def _prune_buffer(self):
-        segs = sorted_segments(self.ram_dir)
-        durations = [get_segment_duration(s) for s in segs]
-        total = sum(durations)
-        while total > PRE_BUFFER_SEC and len(segs) > 1:
-            oldest = segs.pop(0)
-            total -= durations.pop(0)
-            try:
-                oldest.unlink()
-                log.debug("[%s] Odstranen segment: %s (buffer: %.1fs)",
-                          self.name, oldest.name, total)
-            except FileNotFoundError:
-                pass
-
-    # ── Segment watcher ───────────────────────────────────────────────────────
-    def _segment_watcher(self):
-        known: set[str] = set()
-        while not _shutdown.is_set():
-            current = {p.name for p in self.ram_dir.glob("buffer_*_*.ts")}
-            new_files = current - known
-            if new_files:
-                time.sleep(0.3)
-                for name in sorted(new_files):
-                    log.debug("[%s] Novy segment: %s", self.name, name)
-                known = current
-                st, _ = self._get_state()
-                if st == self.IDLE:
-                    self._prune_buffer()
-
-            if self._try_end_recording():
-                self._finalize_event.set()
-
-            time.sleep(0.5)
-
-    # ── Finalizační thread ────────────────────────────────────────────────────
-    def _finalizer(self):
-        while not _shutdown.is_set():
-            triggered = self._finalize_event.wait(timeout=2.0)
-            if _shutdown.is_set():
-                break
-            if not triggered:
-                continue
-            self._finalize_event.clear()
+        if BUFFER_MODE == "pipe":
+            self._ring.trim(PRE_BUFFER_SEC)
+            self._report_usage()
+            return
+        total = sum(dur for _, dur, _ in self._segments)
+        while total > PRE_BUFFER_SEC and len(self._segments) > 1:
+            oldest, dur, _ = self._segments.pop(0)
+            total -= dur
+            oldest.unlink(missing_ok=True)
+            log.debug("[%s] Odstranen segment: %s (buffer: %.1fs)",
+                      self.name, oldest.name, total)
+        self._report_usage()
+
+    def _on_segment(self, seg: Path, duration: float):
+        self._last_segment = time.monotonic()
+        try:
+            size = seg.stat().st_size
+        except FileNotFoundError:
+            return
+        log.debug("[%s] Novy segment: %s (%.2fs)", self.name, seg.name, duration)
+        self._segments.append((seg, duration, size))
+        if self._state == self.IDLE:
+            self._prune_buffer()
+        else:
+            self._report_usage()
+            self._check_recording_limits()
+
+    def _on_gop(self, gop: Gop):
+        """Uzavřená GOP v TsRing – pro watchdog a limity stejně jako nový segment."""
+        self._last_segment = time.monotonic()
+        self._last_gop_sec = gop.duration
+        log.debug("[%s] Nova GOP: %.2fs, %d B", self.name, gop.duration, len(gop.data))
+        if self._state == self.IDLE:
+            self._prune_buffer()
+        else:
+            self._report_usage()
+            self._check_recording_limits()
 
-            st, last_det = self._get_state()
-            if st != self.FINALIZING:
-                continue
+    # ── Finalizace ────────────────────────────────────────────────────────────
+    async def _finalize_after_delay(self):
+        if BUFFER_MODE == "pipe":
+            await self._finalize_ring()
+            return
+        # Počkej, než ffmpeg uzavře segment s koncem post-window
+        await asyncio.sleep(SEGMENT_DURATION + 0.5)
+        if self._state != self.FINALIZING:
+            return
 
-            time.sleep(SEGMENT_DURATION + 0.5)
+        # Klip předaný na disk se pojmenuje časem předání
+        clip_time = time.time() if self._spilling else self._last_det_time
+        detection_ts = datetime.fromtimestamp(
+            clip_time, tz=timezone.utc).strftime("%Y%m%d_%H%M%S")
 
-            st, last_det = self._get_state()
-            if st != self.FINALIZING:
+        done = self._segments
+        self._segments = []
+        traces, self._traces = self._traces, []
+        self._finalize_running = True
+        try:
+            await self._loop.run_in_executor(
+                _executor, self._finalize, detection_ts, [seg for seg, _, _ in done], traces,
+                [dur for _, dur, _ in done])
+        except Exception as e:
+            log.error("[%s] Finalizace selhala: %s", self.name, e)
+
+        # Konec klipu zůstává v RAM jako pre-buffer dalšího klipu; překryv se
+        # na disku neukládá znovu díky SegmentStore
+        keep: list[tuple[Path, float, int]] = []
+        kept_sec = 0.0
+        for entry in reversed(done):
+            if kept_sec >= PRE_BUFFER_SEC:
+                entry[0].unlink(missing_ok=True)
                 continue
+            keep.insert(0, entry)
+            kept_sec += entry[1]
+        self._segments[:0] = keep
+        self._report_usage()
+        self._end_finalizing()
+
+    async def _finalize_ring(self):
+        # Klip končí přesně koncem post-window (při předání na disk teď);
+        # čeká se jen na další klíčový snímek, aby poslední GOP byla celá
+        cutoff = time.time() if self._spilling else self._last_det_time + POST_DETECTION_SEC
+        deadline = time.monotonic() + self._segment_timeout()
+        while not self._ring.passed(cutoff) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            if self._state != self.FINALIZING:
+                return
+        if self._state != self.FINALIZING:
+            return
 
-            detection_ts = datetime.fromtimestamp(
-                last_det, tz=timezone.utc).strftime("%Y%m%d_%H%M%S")
-            self._finalize(detection_ts)
-            self._end_finalizing()
-
-    # ── Finalizace ────────────────────────────────────────────────────────────
-    def _finalize(self, detection_ts: str):
-        segs = sorted_segments(self.ram_dir)
+        clip_time = time.time() if self._spilling else self._last_det_time
+        detection_ts = datetime.fromtimestamp(
+            clip_time, tz=timezone.utc).strftime("%Y%m%d_%H%M%S")
+
+        gops = self._ring.take(cutoff)
+        # Začátek přesně PRE_BUFFER_SEC před první detekcí, zaokrouhleno na GOP
+        start = self._rec_start - PRE_BUFFER_SEC
+        while len(gops) > 1 and gops[1].wall <= start:
+            gops.pop(0)
+        traces, self._traces = self._traces, []
+        self._finalize_running = True
+        try:
+            await self._loop.run_in_executor(
+                _executor, self._finalize_gops, detection_ts, gops,
+                self._ring.headers(), traces)
+        except Exception as e:
+            log.error("[%s] Finalizace selhala: %s", self.name, e)
+
+        # Konec klipu zůstává v paměti jako pre-buffer dalšího klipu
+        keep: list[Gop] = []
+        kept_sec = 0.0
+        for gop in reversed(gops):
+            if kept_sec >= PRE_BUFFER_SEC:
+                break
+            keep.insert(0, gop)
+            kept_sec += gop.duration
+        self._ring.restore(keep)
+        self._report_usage()
+        self._end_finalizing()
+
+    def _finalize_gops(self, detection_ts: str, gops: list[Gop], headers: bytes,
+                       traces: list[Trace]):
+        """Běží v executoru – zapíše GOP z paměti jako segmenty a předá je _finalize."""
+        segs: list[Path] = []
+        durations: list[float] = []
+        try:
+            for group in group_gops(gops):
+                path = self.staging / f"{detection_ts}_{len(segs):03d}.ts"
+                with open(path, "wb") as f:
+                    f.write(headers)
+                    for gop in group:
+                        f.write(gop.data)
+                segs.append(path)
+                durations.append(round(sum(gop.duration for gop in group), 3))
+            self._finalize(detection_ts, segs, traces, durations, move=True)
+        finally:
+            for seg in segs:
+                seg.unlink(missing_ok=True)
+
+    def _finalize(self, detection_ts: str, segs: list[Path], traces: list[Trace] = (),
+                  durations: list[float] = None, move: bool = False):
+        """Běží v executoru – ukládá segmenty a volá ffmpeg/ffprobe.
+        Segmenty v RAM maže volající; `durations` ušetří ffprobe,
+        `move` = segmenty jsou dočasné soubory na disku."""
+        for trace in traces:
+            trace.mark("finalize_start")
         if not segs:
             log.warning("[%s] Zadne segmenty!", self.name)
             return
@@ -310,137 +1450,758 @@ class CameraRecorder:
         for s in segs:
             log.info("[%s]   %s", self.name, s.name)
 
-        self.out_ts.mkdir(parents=True, exist_ok=True)
-        self.out_m3u8.mkdir(parents=True, exist_ok=True)
-        self.out_mp4.mkdir(parents=True, exist_ok=True)
+        # Výstup je rozdělený do adresářů podle dne detekce
+        shard    = date_shard(detection_ts)
+        out_ts   = self.out_ts / shard
+        out_m3u8 = self.out_m3u8 / shard
+        out_mp4  = self.out_mp4 / shard
+        out_m3u8.mkdir(parents=True, exist_ok=True)
+        out_mp4.mkdir(parents=True, exist_ok=True)
 
         # Prefix pro soubory: did_streamtype_timestamp
         prefix = f"{self.did}_{self.stream_type}_{detection_ts}"
 
-        # 1) Kopíruj segmenty
+        if OUTPUT_FORMAT == "fmp4":
+            self._finalize_fmp4(segs, detection_ts, prefix, out_m3u8, out_mp4, traces,
+                                durations)
+            return
+
+        # 1) Ulož segmenty (stejný obsah jen jednou)
+        out_ts.mkdir(parents=True, exist_ok=True)
         copied: list[Path] = []
-        for seg in segs:
-            dest = self.out_ts / seg.name
+        copied_durations: list[float] = []
+        for i, seg in enumerate(segs):
             try:
-                shutil.copy2(seg, dest)
-                copied.append(dest)
+                copied.append(self.retention.store.put(seg, out_ts, move))
             except Exception as e:
                 log.error("[%s] Kopie %s: %s", self.name, seg.name, e)
+                continue
+            if durations is not None:
+                copied_durations.append(durations[i])
+        if durations is not None:
+            durations = copied_durations
 
         if not copied:
             return
+        segment_bytes = self.retention.store.add_clip(prefix, copied)
 
         # 2) M3U8
-        m3u8_path = self.out_m3u8 / f"detection_{prefix}.m3u8"
-        write_m3u8(m3u8_path, copied)
+        m3u8_path = out_m3u8 / f"detection_{prefix}.m3u8"
+        write_m3u8(m3u8_path, copied, durations)
         log.info("[%s] M3U8: %s", self.name, m3u8_path)
 
-        # 3) M3U8 meta
-        write_meta(
-            self.out_m3u8 / f"detection_{prefix}.m3u8.meta",
-            self.did, self.stream_type, detection_ts
+        # 3) M3U8 meta – zápisem meta je klip pro web hotový
+        for trace in traces:
+            trace.mark("written")
+        meta = write_meta(
+            out_m3u8 / f"detection_{prefix}.m3u8.meta",
+            self.did, self.stream_type, detection_ts, traces
         )
 
         # 3b) Thumbnail z půlky videa
-        create_thumbnail(copied, self.out_m3u8 / f"detection_{prefix}.m3u8.jpg")
+        thumb_path = out_m3u8 / f"detection_{prefix}.m3u8.jpg"
+        create_thumbnail(copied, thumb_path, durations)
 
         # 4) MP4
-        mp4_path = self.out_mp4 / f"detection_{prefix}.mp4"
+        mp4_path = out_mp4 / f"detection_{prefix}.mp4"
         create_mp4_concat(copied, mp4_path)
 
         # 5) MP4 meta
-        write_meta(
-            self.out_mp4 / f"detection_{prefix}.mp4.meta",
-            self.did, self.stream_type, detection_ts
-        )
+        mp4_meta_path = out_mp4 / f"detection_{prefix}.mp4.meta"
+        write_meta(mp4_meta_path, self.did, self.stream_type, detection_ts, traces)
+
+        # 6) Evidence a limity retence
+        self.retention.add_clip(prefix, self.did, self.stream_type, meta["timestamp"], {
+            RetentionManager.PRIMARY: [m3u8_path, m3u8_path.with_name(m3u8_path.name + ".meta"),
+                                       thumb_path],
+            "mp4": [mp4_path, mp4_meta_path],
+        }, segment_bytes)
+        self.retention.enforce()
+        latency.written(traces)
+
+    def _finalize_fmp4(self, segs: list[Path], detection_ts: str, prefix: str,
+                       out_m3u8: Path, out_mp4: Path, traces: list[Trace],
+                       durations: list[float] = None):
+        """Jeden fMP4 ke stažení i k přehrávání; M3U8 do něj ukazuje byte-range."""
+        # 1) fMP4 přímo ze segmentů v RAM
+        mp4_path = out_mp4 / f"detection_{prefix}.mp4"
+        if not create_mp4_concat(segs, mp4_path, fragmented=True):
+            return
 
-        # 6) Vyčisti RAM
-        for seg in segs:
-            try:
-                seg.unlink()
-            except FileNotFoundError:
-                pass
+        # 2) M3U8 nad fMP4
+        m3u8_path = out_m3u8 / f"detection_{prefix}.m3u8"
+        try:
+            write_m3u8_fmp4(m3u8_path, mp4_path)
+        except Exception as e:
+            log.error("[%s] M3U8 (fMP4) chyba: %s", self.name, e)
+            return
+        log.info("[%s] M3U8: %s", self.name, m3u8_path)
+
+        # 3) Meta, thumbnail (z RAM segmentů), MP4 meta
+        for trace in traces:
+            trace.mark("written")
+        meta = write_meta(
+            out_m3u8 / f"detection_{prefix}.m3u8.meta",
+            self.did, self.stream_type, detection_ts, traces
+        )
+        thumb_path = out_m3u8 / f"detection_{prefix}.m3u8.jpg"
+        create_thumbnail(segs, thumb_path, durations)
+        mp4_meta_path = out_mp4 / f"detection_{prefix}.mp4.meta"
+        write_meta(mp4_meta_path, self.did, self.stream_type, detection_ts, traces)
+
+        # 4) Evidence a limity retence – MP4 tu není redundantní, je to jediná varianta
+        self.retention.add_clip(prefix, self.did, self.stream_type, meta["timestamp"], {
+            RetentionManager.PRIMARY: [m3u8_path, m3u8_path.with_name(m3u8_path.name + ".meta"),
+                                       thumb_path, mp4_path, mp4_meta_path],
+        }, 0)
+        self.retention.enforce()
+        latency.written(traces)
 
     # ── FFmpeg s auto-restartem ───────────────────────────────────────────────
-    def _run_segmenter(self):
-        segment_pattern = str(self.ram_dir / "buffer_%Y%m%d_%H%M%S.ts")
+    def _segmenter_cmd(self) -> list[str]:
         cmd = [
             "ffmpeg",
             "-loglevel", "warning",
+            "-nostats",
+            # Strojově čitelný průběh (key=value) pro watchdog, na stderr
+            "-progress", "pipe:2",
+            "-stats_period", "1",
             "-rtsp_transport", "tcp",
         ] + self.extra_args + [
             "-i", self.rtsp_url,
             "-c:v", "copy",
             "-c:a", "aac",
             "-b:a", "128k",
+        ]
+        if BUFFER_MODE == "pipe":
+            # Souvislý MPEG-TS na stdout, GOP si odděluje TsRing
+            return cmd + ["-f", "mpegts", "pipe:1"]
+        segment_pattern = str(self.ram_dir / "buffer_%Y%m%d_%H%M%S.ts")
+        return cmd + [
             "-f", "segment",
             "-segment_time", str(SEGMENT_DURATION),
             "-strftime", "1",
             "-reset_timestamps", "1",
             "-segment_format", "mpegts",
+            # Každý uzavřený segment ohlásí řádkem "soubor,start,konec" na stdout
+            "-segment_list", "pipe:1",
+            "-segment_list_type", "csv",
             segment_pattern,
         ]
 
-        retry_delay = 5
-        while not _shutdown.is_set():
-            log.info("[%s] Spoustim ffmpeg...", self.name)
-            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
-                                    stderr=subprocess.PIPE)
-            for line in proc.stderr:
-                if _shutdown.is_set():
-                    proc.kill()
-                    break
-                txt = line.decode(errors="replace").strip()
-                if txt:
-                    log.debug("[%s][ffmpeg] %s", self.name, txt)
-            proc.wait()
-            if _shutdown.is_set():
+    async def _read_segment_list(self, stream: asyncio.StreamReader):
+        async for line in stream:
+            parts = line.decode(errors="replace").strip().split(",")
+            if len(parts) < 3:
+                continue
+            try:
+                duration = round(float(parts[2]) - float(parts[1]), 3)
+            except ValueError:
+                duration = float(SEGMENT_DURATION)
+            self._on_segment(self.ram_dir / Path(parts[0]).name, duration)
+
+    async def _read_ts(self, stream: asyncio.StreamReader):
+        while True:
+            chunk = await stream.read(1 << 16)
+            if not chunk:
                 break
+            for gop in self._ring.feed(chunk):
+                self._on_gop(gop)
+
+    async def _read_stderr(self, stream: asyncio.StreamReader):
+        async for line in stream:
+            txt = line.decode(errors="replace").strip()
+            if not txt:
+                continue
+            key, sep, value = txt.partition("=")
+            if sep and key.isidentifier():
+                # řádek z -progress
+                if key == "out_time_us" and value.isdigit():
+                    out_time = int(value)
+                    if self._last_out_time is None or out_time > self._last_out_time:
+                        self._last_out_time = out_time
+                        self._last_progress = time.monotonic()
+                continue
+            log.debug("[%s][ffmpeg] %s", self.name, txt)
+
+    def _segment_timeout(self) -> float:
+        """Jak dlouho smí chybět nový segment (v režimu "pipe" uzavřená GOP)."""
+        if BUFFER_MODE != "pipe":
+            return SEGMENT_TIMEOUT_SEC
+        if self._last_gop_sec is None:
+            return max(SEGMENT_TIMEOUT_SEC, GOP_TIMEOUT_SEC)
+        return max(SEGMENT_TIMEOUT_SEC, 2 * self._last_gop_sec)
+
+    async def _watchdog(self):
+        """Zabije ffmpeg, který běží, ale nedodává data (visící RTSP)."""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if self._last_progress is None:
+                stalled = now - self._proc_start > STARTUP_TIMEOUT_SEC
+                reason = "zadny progress po startu"
+            elif now - self._last_progress > STALL_TIMEOUT_SEC:
+                stalled, reason = True, "out_time se neposouva"
+            else:
+                since = max(self._last_segment or 0, self._proc_start)
+                stalled = now - since > self._segment_timeout()
+                reason = "neprichazi segmenty"
+                if not stalled and since > self._proc_start:
+                    self._health = self.HEALTHY
+            if stalled:
+                log.warning("[%s] ffmpeg zaseknuty (%s), restartuji...", self.name, reason)
+                self._health = self.STALLED
+                self._stalls += 1
+                self._kill_ffmpeg()
+                return
+
+    async def _run_segmenter(self):
+        retry_delay = RESTART_DELAY_SEC
+        while True:
+            cmd = self._segmenter_cmd()
+            log.info("[%s] Spoustim ffmpeg...", self.name)
+            self._health = self.STARTING
+            self._proc_start = time.monotonic()
+            self._last_progress = self._last_out_time = None
+            if BUFFER_MODE == "pipe":
+                gop = self._ring.restart()
+                if gop is not None:
+                    self._on_gop(gop)
+                read_stdout = self._read_ts
+            else:
+                read_stdout = self._read_segment_list
+            self._proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            watchdog = self._loop.create_task(self._watchdog(), name=f"watchdog-{self.name}")
+            try:
+                await asyncio.gather(read_stdout(self._proc.stdout),
+                                     self._read_stderr(self._proc.stderr))
+                returncode = await self._proc.wait()
+            except asyncio.CancelledError:
+                self._kill_ffmpeg()
+                await self._proc.wait()
+                raise
+            finally:
+                watchdog.cancel()
+
+            if self._reconfigured:
+                # Nová URL/argumenty – hned znovu, buffer v RAM zůstává
+                self._reconfigured = False
+                retry_delay = RESTART_DELAY_SEC
+                continue
+            # Po dostatečně dlouhém zdravém běhu začíná backoff znovu od začátku
+            if time.monotonic() - self._proc_start >= HEALTHY_RUNTIME_SEC:
+                retry_delay = RESTART_DELAY_SEC
+            self._restarts += 1
+            if self._health != self.STALLED:
+                self._health = self.BACKOFF
             log.warning("[%s] ffmpeg skoncil (kod %d), restart za %ds...",
-                        self.name, proc.returncode, retry_delay)
-            time.sleep(retry_delay)
-            retry_delay = min(retry_delay * 2, 60)
+                        self.name, returncode, retry_delay)
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, RESTART_DELAY_MAX)
+
+    def health(self) -> dict:
+        """Stav kamery pro metriky."""
+        now = time.monotonic()
+
+        def age(t):
+            return round(now - t, 1) if t else None
+
+        return {
+            "health": self._health,
+            "state": self._state,
+            "restarts": self._restarts,
+            "stalls": self._stalls,
+            "uptime": age(self._proc_start),
+            "last_progress_age": age(self._last_progress),
+            "last_segment_age": age(self._last_segment),
+            "buffer_sec": round(self._buffer_sec(), 1),
+        }
+
+    def _kill_ffmpeg(self):
+        if self._proc and self._proc.returncode is None:
+            self._proc.kill()
+
+    # ── Životní cyklus ────────────────────────────────────────────────────────
+    def _spawn(self, coro, name: str):
+        task = self._loop.create_task(coro, name=name)
+        self._tasks.append(task)
+        task.add_done_callback(self._tasks.remove)
 
     def start(self):
-        """Spustí všechny thready pro tuto kameru."""
-        threading.Thread(target=self._segment_watcher, daemon=True,
-                         name=f"watcher-{self.name}").start()
-        threading.Thread(target=self._finalizer, daemon=True,
-                         name=f"finalizer-{self.name}").start()
-        threading.Thread(target=self._run_segmenter, daemon=True,
-                         name=f"ffmpeg-{self.name}").start()
+        """Spustí supervizi ffmpeg v běžícím event loopu."""
+        self._loop = asyncio.get_running_loop()
+        self._spawn(self._run_segmenter(), f"ffmpeg-{self.name}")
         log.info("[%s] Kamera spustena (RTSP: %s)", self.name, self.rtsp_url)
 
-
-# ─── MQTT ─────────────────────────────────────────────────────────────────────
-def build_topic_map(cameras: dict) -> dict[str, list[CameraRecorder]]:
-    """Vrátí mapping topic → [CameraRecorder, ...] a spustí recordery."""
-    topic_map: dict[str, list[CameraRecorder]] = {}
+    def reconfigure(self, rtsp_url: str, extra_args: list):
+        """Restartuje jen ffmpeg s novou URL/argumenty; pre-buffer zůstává."""
+        self.rtsp_url   = rtsp_url
+        self.extra_args = [str(a) for a in (extra_args or [])]
+        log.info("[%s] Zmena konfigurace, restartuji ffmpeg (RTSP: %s)", self.name, rtsp_url)
+        if self._proc and self._proc.returncode is None:
+            self._reconfigured = True
+            self._kill_ffmpeg()
+
+    async def stop(self):
+        """Ukončí ffmpeg a zruší rozpracované úlohy."""
+        if self._post_timer:
+            self._post_timer.cancel()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        ram_budget.release(self.name)
+
+    async def retire(self):
+        """Odebrání z konfigurace: dokončí rozpracovaný klip, pak zastaví a uklidí RAM."""
+        if not self._idle.is_set():
+            log.info("[%s] Odebrana z konfigurace, cekam na dokonceni klipu...", self.name)
+            await self._idle.wait()
+        await self.stop()
+        for seg, _, _ in self._segments:
+            seg.unlink(missing_ok=True)
+        self._segments.clear()
+        self._ring.clear()
+        log.info("[%s] Kamera zastavena", self.name)
+
+
+# ─── Sada kamer ───────────────────────────────────────────────────────────────
+def detection_did(topic: str) -> str | None:
+    """did z topicu tvaru MQTT_DETECTION_TOPIC, jinak None."""
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == MQTT_BASE_TOPIC and parts[2] == "bird_detection":
+        return parts[1]
+    return None
+
+
+# Pole detekce, která NVR potřebuje; payload se celý neparsuje
+_DETECTION_FIELD = re.compile(rb'"(timestamp|trace_id|seq)"\s*:\s*(-?\d+(?:\.\d+)?|"[^"\\]*")')
+
+
+def detection_fields(payload: bytes) -> dict | None:
+    """timestamp, trace_id a seq z payloadu bird_detection bez parsování celého
+    JSON. V dávce (events) platí poslední výskyt, tj. poslední detekce.
+    None, pokud payload není JSON objekt."""
+    if not payload.lstrip().startswith(b"{"):
+        return None
+    return {key.decode(): json.loads(value) for key, value in _DETECTION_FIELD.findall(payload)}
+
+
+def parse_streams(cameras: dict, retention_cfg: dict = None) -> dict[str, dict]:
+    """conf.yaml → {"did/stream_type": {did, stream_type, topic, url, extra, retention}}."""
+    specs: dict[str, dict] = {}
     for did, cfg in cameras.items():
-        topic = cfg["topic"]
-        recorders = []
         for stream_type, stream_cfg in cfg["streams"].items():
             # stream může být jen string (url) nebo dict s url + ffmpeg_extra_args
             if isinstance(stream_cfg, str):
-                rtsp_url = stream_cfg
-                extra = []
-            else:
-                rtsp_url = stream_cfg["url"]
-                extra = stream_cfg.get("ffmpeg_extra_args", [])
-            rec = CameraRecorder(did, stream_type, rtsp_url, extra_args=extra)
-            rec.start()
-            recorders.append(rec)
-        topic_map[topic] = recorders
-        log.info("Topic '%s' → %d stream(u): %s",
-                 topic, len(recorders), list(cfg["streams"].keys()))
-    return topic_map
-
-
-def start_mqtt(topic_map: dict[str, list[CameraRecorder]]) -> mqtt.Client:
+                stream_cfg = {"url": stream_cfg}
+            specs[f"{did}/{stream_type}"] = {
+                "did": did,
+                "stream_type": stream_type,
+                "topic": cfg["topic"],
+                "url": stream_cfg["url"],
+                "extra": [str(a) for a in stream_cfg.get("ffmpeg_extra_args", [])],
+                # retence: globální ← kamera ← stream
+                "retention": {
+                    **(retention_cfg or {}),
+                    **cfg.get("retention", {}),
+                    **stream_cfg.get("retention", {}),
+                },
+            }
+    return specs
+
+
+def build_routes(specs: dict[str, dict], targets: dict) -> tuple[dict, dict]:
+    """did → [cíl, ...] pro topicy pod wildcardem, topic → [...] pro ostatní.
+    Cíl je CameraRecorder nebo jeho zástupce v supervizoru."""
+    did_map: dict[str, list] = {}
+    topic_map: dict[str, list] = {}
+    for name, spec in specs.items():
+        did = detection_did(spec["topic"])
+        if did is not None:
+            recs = did_map.setdefault(did, [])
+        else:
+            recs = topic_map.setdefault(spec["topic"], [])
+        # Stream čekající na start (viz CameraSet) má topic, ale zatím bez cíle
+        if name in targets:
+            recs.append(targets[name])
+    for key, recs in {**did_map, **topic_map}.items():
+        log.info("Detekce '%s' → %d stream(u): %s",
+                 key, len(recs), [r.stream_type for r in recs])
+    return did_map, topic_map
+
+
+class CameraSet:
+    """
+    Běžící recordery podle conf.yaml. apply() porovná novou konfiguraci
+    s běžící: nové streamy spustí, odebrané zastaví po dokončení klipu,
+    změněným restartuje jen ffmpeg a ostatní nechá být (i s pre-bufferem).
+    """
+
+    def __init__(self):
+        self.specs: dict[str, dict] = {}
+        self.recorders: dict[str, CameraRecorder] = {}
+        # did → [CameraRecorder, ...] pro topicy pod wildcardem, topic → [...]
+        # pro ostatní; při změně se nahrazují celé slovníky, MQTT thread tak
+        # vždy čte konzistentní mapu
+        self.did_map: dict[str, list[CameraRecorder]] = {}
+        self.topic_map: dict[str, list[CameraRecorder]] = {}
+        self._retiring: dict[str, asyncio.Task] = {}   # odebrané, dokončují klip
+        self._pending: dict[str, asyncio.Task] = {}    # znovu přidané, čekají na ně
+
+    def apply(self, specs: dict[str, dict]):
+        old = self.specs
+        loop = asyncio.get_running_loop()
+        for name in old.keys() - specs.keys():
+            rec = self.recorders.pop(name, None)
+            if rec is None:
+                continue    # ještě čekal na start, ten už ho nespustí
+            task = loop.create_task(rec.retire(), name=f"retire-{name}")
+            self._retiring[name] = task
+            task.add_done_callback(lambda t, name=name: self._retired(name, t))
+        for name, spec in specs.items():
+            retention_for(spec["did"]).set_policy(spec["did"], spec["stream_type"],
+                                                  spec["retention"])
+            prev = old.get(name)
+            if name in self._pending:
+                continue    # spustí se s aktuální konfigurací
+            if prev is None and name in self._retiring:
+                # Stejný stream se ještě dokončuje; nový recorder by mu ve
+                # sdíleném ram_dir smazal neuložené segmenty
+                self._pending[name] = loop.create_task(self._start_after_retire(name),
+                                                       name=f"start-{name}")
+            elif prev is None:
+                self._start(name, spec)
+            elif (prev["url"], prev["extra"]) != (spec["url"], spec["extra"]):
+                self.recorders[name].reconfigure(spec["url"], spec["extra"])
+        self.specs = specs
+        self.did_map, self.topic_map = build_routes(specs, self.recorders)
+
+    def _start(self, name: str, spec: dict):
+        rec = CameraRecorder(spec["did"], spec["stream_type"], spec["url"],
+                             extra_args=spec["extra"])
+        rec.start()
+        self.recorders[name] = rec
+
+    def _retired(self, name: str, task: asyncio.Task):
+        if self._retiring.get(name) is task:
+            del self._retiring[name]
+
+    async def _start_after_retire(self, name: str):
+        log.info("[%s] Znovu pridana, cekam na dokonceni puvodni...", name)
+        await asyncio.wait([self._retiring[name]])
+        del self._pending[name]
+        spec = self.specs.get(name)
+        if spec is None:
+            return
+        self._start(name, spec)
+        self.did_map, self.topic_map = build_routes(self.specs, self.recorders)
+
+    def route(self, topic: str) -> list[CameraRecorder]:
+        did = detection_did(topic)
+        if did is not None:
+            return self.did_map.get(did, [])
+        return self.topic_map.get(topic, [])
+
+    def all(self) -> list[CameraRecorder]:
+        return list(self.recorders.values())
+
+    async def stop(self):
+        for task in self._pending.values():
+            task.cancel()
+        await asyncio.gather(*(rec.stop() for rec in self.all()), *self._retiring.values(),
+                             *self._pending.values(), return_exceptions=True)
+
+
+# ─── Supervizor (kamery v pracovních procesech) ───────────────────────────────
+def worker_key(did: str) -> str:
+    """Do kterého procesu patří kamera; všechny streamy budky jsou v jednom."""
+    if CAMERA_WORKERS == "did":
+        return did
+    return f"w{zlib.crc32(did.encode()) % CAMERA_WORKERS}"
+
+
+def camera_worker_main(key: str, specs: dict[str, dict], conn, log_queue, ram_share: float):
+    """Vstupní bod pracovního procesu: vlastní event loop, recordery a evidence."""
+    global ram_budget
+    # Logy jdou frontou do supervizoru, ten je vypisuje s ostatními
+    handler = QueueHandler(log_queue)
+    handler.setFormatter(logging.Formatter(f"[{key}] %(message)s"))
+    logging.getLogger().handlers[:] = [handler]
+    # Ctrl+C dostane celá skupina procesů, SIGTERM od systemd celá cgroup –
+    # ukončení řídí supervizor, aby workery stihly dokončit rozpracované klipy
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    ram_budget = RamBudget(int(RAM_BUDGET_BYTES * ram_share), RAM_SPILL_RATIO)
+    asyncio.run(run_camera_worker(specs, conn))
+
+
+async def run_camera_worker(specs: dict[str, dict], conn):
+    loop = asyncio.get_running_loop()
+    cameras = CameraSet()
+    cameras.apply(specs)
+    await loop.run_in_executor(_executor, enforce_retention)
+
+    done = asyncio.Event()
+    retire = False
+
+    def on_command():
+        nonlocal retire
+        try:
+            while conn.poll():
+                msg = conn.recv()
+                if msg[0] == "trigger":
+                    rec = cameras.recorders.get(msg[1])
+                    if rec:
+                        rec.trigger_detection(*msg[2:])
+                elif msg[0] == "apply":
+                    cameras.apply(msg[1])
+                    ram_budget.limit = int(RAM_BUDGET_BYTES * msg[2])
+                elif msg[0] == "retire":
+                    retire = True
+                    done.set()
+                elif msg[0] == "stop":
+                    done.set()
+        except (EOFError, OSError):
+            # Supervizor skončil
+            loop.remove_reader(conn.fileno())
+            done.set()
+
+    loop.add_reader(conn.fileno(), on_command)
+    while not done.is_set():
+        try:
+            await asyncio.wait_for(done.wait(), timeout=METRICS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        ram_budget.report()
+        report_storage()
+        latency.poll_sync_log()
+        latency.report()
+        set_metric("cameras", {rec.name: rec.health() for rec in cameras.all()})
+        with _metrics_lock:
+            snapshot = dict(_metrics)
+        try:
+            conn.send(("metrics", snapshot))
+        except OSError:
+            break
+
+    if retire:
+        # Odebrané kamery nejdřív dokončí rozpracované klipy
+        cameras.apply({})
+    await cameras.stop()
+    _executor.shutdown(wait=True)
+
+
+class CameraProxy:
+    """Zástupce recorderu z pracovního procesu – detekci předá rourou."""
+
+    def __init__(self, worker: "CameraWorker", name: str, stream_type: str):
+        self.worker      = worker
+        self.name        = name
+        self.stream_type = stream_type
+
+    def trigger_detection(self, trace_id: str = None, rx_time: float = None, device_ts=None):
+        self.worker.send(("trigger", self.name, trace_id, rx_time, device_ts))
+
+
+class CameraWorker:
+    """Jeden pracovní proces s kamerami; po pádu ho WorkerSet spustí znovu."""
+
+    def __init__(self, key: str, specs: dict[str, dict], workers: "WorkerSet"):
+        self.key      = key
+        self.specs    = specs
+        self.workers  = workers
+        self.proc     = None
+        self.conn     = None
+        self.restarts = 0
+        self.metrics: dict = {}
+        self.retiring = False
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child = ctx.Pipe()
+        # Ne daemon: ten by multiprocessing při ukončení zastavoval přes SIGTERM,
+        # který workery ignorují – zbylé zabije WorkerSet.kill()
+        self.proc = ctx.Process(target=camera_worker_main, name=f"nvr-{self.key}", daemon=False,
+                                args=(self.key, self.specs, child, self.workers.log_queue,
+                                      self.workers.ram_share(self)))
+        self.proc.start()
+        child.close()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self._on_message)
+        loop.add_reader(self.proc.sentinel, self._on_exit)
+        log.info("[%s] Worker spusten (pid %d, %d streamu)", self.key, self.proc.pid,
+                 len(self.specs))
+
+    def send(self, msg: tuple):
+        try:
+            self.conn.send(msg)
+        except OSError as e:
+            log.warning("[%s] Worker nedostupny (%s), zahazuji %s", self.key, e, msg[0])
+
+    def _on_message(self):
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                if msg[0] == "metrics":
+                    self.metrics = msg[1]
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+
+    def _on_exit(self):
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.proc.sentinel)
+        loop.remove_reader(self.conn.fileno())
+        self.conn.close()
+        self.proc.join()
+        if self.retiring or self.workers.stopping:
+            self.workers.finished(self)
+            return
+        self.restarts += 1
+        log.error("[%s] Worker skoncil (kod %s), restart za %ds...",
+                  self.key, self.proc.exitcode, RESTART_DELAY_SEC)
+        loop.call_later(RESTART_DELAY_SEC, self._restart)
+
+    def _restart(self):
+        if not (self.retiring or self.workers.stopping):
+            self.start()
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.is_alive()
+
+
+class WorkerSet:
+    """
+    CameraSet pro CAMERA_WORKERS: kamery běží v pracovních procesech,
+    supervizor jen přijímá MQTT a předává detekce rourou. Pád jednoho
+    procesu ostatní kamery (ani jejich pre-buffery) neovlivní.
+    """
+
+    def __init__(self):
+        self.specs: dict[str, dict] = {}
+        self.workers: dict[str, CameraWorker] = {}
+        self.proxies: dict[str, CameraProxy] = {}
+        self.did_map: dict[str, list[CameraProxy]] = {}
+        self.topic_map: dict[str, list[CameraProxy]] = {}
+        self.stopping = False
+        self._ended = asyncio.Event()
+        self.log_queue = multiprocessing.get_context("spawn").Queue()
+        # Výpis logů z workerů přes handlery tohoto procesu
+        self._log_listener = QueueListener(self.log_queue, *logging.getLogger().handlers)
+        self._log_listener.start()
+        # Běží před join() potomků v atexit multiprocessingu (i po výjimce)
+        atexit.register(self.kill)
+
+    def apply(self, specs: dict[str, dict]):
+        old_groups: dict[str, dict] = {}
+        for name, spec in self.specs.items():
+            old_groups.setdefault(worker_key(spec["did"]), {})[name] = spec
+        groups: dict[str, dict] = {}
+        for name, spec in specs.items():
+            groups.setdefault(worker_key(spec["did"]), {})[name] = spec
+        self.specs = specs
+
+        for key in old_groups.keys() - groups.keys():
+            worker = self.workers[key]
+            worker.retiring = True
+            worker.send(("retire",))
+        for key, group in groups.items():
+            worker = self.workers.get(key)
+            if worker is None:
+                worker = self.workers[key] = CameraWorker(key, group, self)
+                worker.start()
+            elif worker.retiring:
+                # Skupina se ještě dokončuje; nový proces by sdílel její evidenci
+                # a RAM adresáře – spustí ho finished() až po jejím skončení
+                continue
+            elif group != old_groups.get(key):
+                worker.specs = group
+                worker.send(("apply", group, self.ram_share(worker)))
+        self._route()
+
+    def _route(self):
+        self.proxies = {name: CameraProxy(self.workers[worker_key(spec["did"])], name,
+                                          spec["stream_type"])
+                        for name, spec in self.specs.items()}
+        self.did_map, self.topic_map = build_routes(self.specs, self.proxies)
+
+    def ram_share(self, worker: CameraWorker) -> float:
+        """Díl rozpočtu RAM podle počtu streamů workeru."""
+        return len(worker.specs) / max(len(self.specs), 1)
+
+    def finished(self, worker: CameraWorker):
+        if self.workers.get(worker.key) is worker:
+            del self.workers[worker.key]
+            log.info("[%s] Worker ukoncen", worker.key)
+            group = {name: spec for name, spec in self.specs.items()
+                     if worker_key(spec["did"]) == worker.key}
+            if group and not self.stopping:
+                # Mezitím znovu přidaná skupina
+                replacement = self.workers[worker.key] = CameraWorker(worker.key, group, self)
+                replacement.start()
+                self._route()
+                return
+        if not self.workers:
+            self._ended.set()
+
+    def route(self, topic: str) -> list[CameraProxy]:
+        did = detection_did(topic)
+        if did is not None:
+            return self.did_map.get(did, [])
+        return self.topic_map.get(topic, [])
+
+    def report(self):
+        """Souhrnné metriky: stav všech kamer a zdraví workerů."""
+        cameras, workers = {}, {}
+        for key, worker in self.workers.items():
+            cameras.update(worker.metrics.get("cameras", {}))
+            workers[key] = {
+                "pid": worker.proc.pid if worker.proc else None,
+                "alive": worker.alive(),
+                "restarts": worker.restarts,
+                "streams": sorted(worker.specs),
+                **{section: worker.metrics[section]
+                   for section in ("ram", "storage", "latency") if section in worker.metrics},
+            }
+        set_metric("cameras", cameras)
+        set_metric("workers", workers)
+
+    async def stop(self):
+        self.stopping = True
+        if self.workers:
+            for worker in self.workers.values():
+                worker.send(("stop",))
+            try:
+                await asyncio.wait_for(self._ended.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                for worker in self.workers.values():
+                    if worker.alive():
+                        log.warning("[%s] Worker nereaguje, ukoncuji", worker.key)
+                self.kill()
+        self._log_listener.stop()
+
+    def kill(self):
+        """Zabije a vyčká workery, které ještě běží (SIGTERM ignorují)."""
+        for worker in list(self.workers.values()):
+            if worker.alive():
+                worker.proc.kill()
+                worker.proc.join()
+
+
+# ─── MQTT ─────────────────────────────────────────────────────────────────────
+def trigger_all(recorders: list[CameraRecorder], trace_id: str, rx_time: float, device_ts):
+    for rec in recorders:
+        rec.trigger_detection(trace_id, rx_time, device_ts)
+
+
+def start_mqtt(cameras: "CameraSet | WorkerSet", loop: asyncio.AbstractEventLoop) -> mqtt.Client:
+    """MQTT běží ve vlastním threadu paho, detekce předává do event loopu."""
     def on_connect(client, userdata, flags, rc, *args):
         if rc == 0:
             log.info("MQTT pripojeno → %s:%d", MQTT_BROKER, MQTT_PORT)
-            for topic in topic_map:
+            for topic in [MQTT_DETECTION_TOPIC, *cameras.topic_map]:
                 client.subscribe(topic)
                 log.info("Subscribed: %s", topic)
         else:
@@ -450,22 +2211,30 @@ def start_mqtt(topic_map: dict[str, list[CameraRecorder]]) -> mqtt.Client:
         log.warning("MQTT odpojeno (rc=%d)", rc)
 
     def on_message(client, userdata, msg):
+        rx_time = time.time()
         topic = msg.topic
-        try:
-            data = json.loads(msg.payload.decode())
-        except Exception:
+        # Nejdřív routing podle topicu – budky bez kamery se vůbec neparsují
+        recorders = cameras.route(topic)
+        if not recorders:
+            log.debug("Zadny recorder pro topic: %s", topic)
+            return
+
+        fields = detection_fields(msg.payload)
+        if fields is None:
             log.warning("MQTT: nelze parsovat payload z '%s'", topic)
             return
+        device_ts = fields.get("timestamp")
+        trace_id = fields.get("trace_id")
+        seq = fields.get("seq")
 
-        inner = data.get("payload", data)
-        log.info("MQTT <- '%s'  timestamp=%s", topic, inner.get("timestamp", "?"))
+        # trace_id z payloadu, jinak odvozený stejně jako v pruletylog –
+        # sdílí ho všechny streamy detekce
+        trace_id = str(trace_id or detection_trace_id(detection_did(topic) or topic,
+                                                      device_ts, seq))
+        log.info("MQTT <- '%s'  timestamp=%s  trace=%s", topic, device_ts or "?", trace_id)
 
-        recorders = topic_map.get(topic, [])
-        if not recorders:
-            log.debug("Zadny recorder pro topic: %s", topic)
-            return
-        for rec in recorders:
-            rec.trigger_detection()
+        # Všechny streamy budky jedním předáním do event loopu
+        loop.call_soon_threadsafe(trigger_all, recorders, trace_id, rx_time, device_ts)
 
     try:
         client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
@@ -486,38 +2255,98 @@ def start_mqtt(topic_map: dict[str, list[CameraRecorder]]) -> mqtt.Client:
     return client
 
 
+def update_subscriptions(client: mqtt.Client, old_topics: set[str], new_topics: set[str]):
+    """Topicy mimo wildcard detekcí, které přibyly/ubyly při reloadu."""
+    for topic in old_topics - new_topics:
+        client.unsubscribe(topic)
+        log.info("Unsubscribed: %s", topic)
+    for topic in new_topics - old_topics:
+        client.subscribe(topic)
+        log.info("Subscribed: %s", topic)
+
+
 # ─── Main ─────────────────────────────────────────────────────────────────────
-def main():
-    def handle_signal(sig, frame):
-        log.info("Ukoncuji NVR...")
-        _shutdown.set()
-        sys.exit(0)
+def config_mtime() -> float:
+    try:
+        return CONFIG_FILE.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
 
-    signal.signal(signal.SIGINT,  handle_signal)
-    signal.signal(signal.SIGTERM, handle_signal)
 
-    cfg = load_config()
-    cameras = cfg.get("cameras", {})
-    if not cameras:
-        log.error("Zadne kamery v conf.yaml!")
-        sys.exit(1)
+async def run_nvr(cfg: dict):
+    loop = asyncio.get_running_loop()
+    shutdown = asyncio.Event()
+    reload_requested = asyncio.Event()
 
-    log.info("=== NVR start === (%d kamer)", len(cameras))
+    def handle_signal():
+        log.info("Ukoncuji NVR...")
+        shutdown.set()
 
-    topic_map = build_topic_map(cameras)
-    mqtt_client = start_mqtt(topic_map)
+    loop.add_signal_handler(signal.SIGINT,  handle_signal)
+    loop.add_signal_handler(signal.SIGTERM, handle_signal)
+    loop.add_signal_handler(signal.SIGHUP,  reload_requested.set)
 
-    # Hlavní thread jen čeká na shutdown
-    try:
-        while not _shutdown.is_set():
-            time.sleep(1)
-    except KeyboardInterrupt:
-        pass
+    log.info("=== NVR start === (%d kamer)", len(cfg["cameras"]))
+
+    cameras = WorkerSet() if CAMERA_WORKERS else CameraSet()
+    cameras.apply(parse_streams(cfg["cameras"], cfg.get("retention")))
+    mqtt_client = start_mqtt(cameras, loop)
+    if not CAMERA_WORKERS:
+        # Limity se mohly od posledního běhu změnit (workery si je hlídají samy)
+        await loop.run_in_executor(_executor, enforce_retention)
+
+    def reload_config():
+        try:
+            new_cfg = load_config()
+            specs = parse_streams(new_cfg.get("cameras") or {}, new_cfg.get("retention"))
+        except Exception as e:
+            log.error("Reload conf.yaml selhal, ponechavam puvodni konfiguraci: %s", e)
+            return
+        log.info("=== Reload conf.yaml === (%d streamu)", len(specs))
+        old_topics = set(cameras.topic_map)
+        cameras.apply(specs)
+        update_subscriptions(mqtt_client, old_topics, set(cameras.topic_map))
+
+    # Event loop čeká na shutdown, hlídá conf.yaml a průběžně vypisuje metriky
+    mtime = config_mtime()
+    next_metrics = time.monotonic() + METRICS_INTERVAL
+    while not shutdown.is_set():
+        try:
+            await asyncio.wait_for(shutdown.wait(), timeout=CONFIG_POLL_SEC)
+        except asyncio.TimeoutError:
+            pass
+        if config_mtime() != mtime:
+            reload_requested.set()
+        if reload_requested.is_set() and not shutdown.is_set():
+            reload_requested.clear()
+            mtime = config_mtime()
+            reload_config()
+        if time.monotonic() >= next_metrics:
+            next_metrics += METRICS_INTERVAL
+            if CAMERA_WORKERS:
+                cameras.report()
+            else:
+                ram_budget.report()
+                report_storage()
+                latency.poll_sync_log()
+                latency.report()
+                set_metric("cameras", {rec.name: rec.health() for rec in cameras.all()})
+            write_metrics()
 
     mqtt_client.loop_stop()
+    await cameras.stop()
+    _executor.shutdown(wait=True)
+
+
+def main():
+    cfg = load_config()
+    if not cfg.get("cameras"):
+        log.error("Zadne kamery v conf.yaml!")
+        sys.exit(1)
+
+    asyncio.run(run_nvr(cfg))
     log.info("NVR ukoncen.")
 
 
 if __name__ == "__main__":
     main()
-
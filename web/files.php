@@ -14,7 +14,20 @@ if (!is_dir($dir)) {
     exit;
 }
 
-$files = glob($dir . '/*.meta');
+// Klipy jsou v adresářích RRRR/MM/DD podle dne detekce (UTC);
+// s časovým filtrem se procházejí jen dny v rozsahu (nejvýš MAX_DAYS,
+// delší rozsah projde všechny dny jedním globem, časový filtr platí dál)
+const MAX_DAYS = 31;
+$files = glob($dir . '/*.meta');  // starší klipy bez rozdělení
+if ($tstart !== null && $tend !== null && $tend >= $tstart && $tend - $tstart <= MAX_DAYS * 86400) {
+    $day = gmmktime(0, 0, 0, (int)gmdate('n', $tstart), (int)gmdate('j', $tstart), (int)gmdate('Y', $tstart));
+    for (; $day <= $tend; $day += 86400) {
+        $files = array_merge($files, glob($dir . '/' . gmdate('Y/m/d', $day) . '/*.meta'));
+    }
+} else {
+    $files = array_merge($files, glob($dir . '/[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]/*.meta'));
+}
+
 foreach ($files as $file) {
     $json = file_get_contents($file);
     $data = json_decode($json, true);
@@ -35,7 +48,8 @@ foreach ($files as $file) {
     // filtr podle did (nest)
     if ($nest !== null && $did !== $nest) continue;
 
-    $videoName = basename($file, '.meta');
+    // cesta relativně k m3u8/ (včetně RRRR/MM/DD), bez přípony .meta
+    $videoName = substr($file, strlen($dir) + 1, -strlen('.meta'));
 
     if (!isset($result[$timestamp]))        $result[$timestamp] = [];
     if (!isset($result[$timestamp][$did]))  $result[$timestamp][$did] = [];